@@ -29,10 +29,15 @@ setup(
         "console_scripts": ["simple-cloud-site = simple_cloud_site.commands.main:main"],
         "simple_cloud_site.commands": [
             "apply-template = simple_cloud_site.commands.apply_template:ApplyTemplate",
+            "benchmark-publish = simple_cloud_site.commands.benchmark:BenchmarkPublish",
+            "build = simple_cloud_site.commands.build:Build",
+            "cache = simple_cloud_site.commands.cache:Cache",
             "devserver = simple_cloud_site.commands.devserver:DevServer",
             "generate-feeds = simple_cloud_site.commands.generate_feeds:GenerateFeeds",
             "publish = simple_cloud_site.commands.publish:Publish",
+            "search-index = simple_cloud_site.commands.search_index:SearchIndex",
             "update-indices = simple_cloud_site.commands.indices:UpdateIndices",
+            "watch = simple_cloud_site.commands.watch:Watch",
         ],
     },
 )
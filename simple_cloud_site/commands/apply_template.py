@@ -3,11 +3,249 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import logging
 import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from cliff.command import Command
 
-from simple_cloud_site.site import load_site
-from simple_cloud_site.templates import apply_template
+from simple_cloud_site.files import md5_file
+from simple_cloud_site.html import Tidier
+from simple_cloud_site.site import PostIndex, RenderedFile, Site, load_site
+from simple_cloud_site.templates import (
+    CompiledTemplate,
+    apply_template,
+    render_fingerprint,
+    render_template,
+)
+
+# Per-process state for the --jobs worker pool, set by init_worker():
+WORKER_STATE = {}
+
+
+def init_worker(config_filename, template_filename, blog_posts, options):
+    # The Site is only used for URL generation so the page cache won't be opened
+    WORKER_STATE.update(
+        site=Site(config_filename),
+        template=CompiledTemplate(template_filename),
+        blog_posts=blog_posts,
+        options=options,
+    )
+
+
+def apply_template_worker(filename):
+    """
+    Apply the template in a worker process, returning (error, content,
+    metadata) where error is any error as a string
+
+    When tidying, the file isn't written and the content is returned instead so
+    it can be passed to the parent process's Tidier. Otherwise the metadata
+    returned by apply_template is passed back so the file isn't parsed again.
+    """
+
+    options = WORKER_STATE["options"]
+
+    try:
+        if options["tidy_html"]:
+            content = render_template(
+                WORKER_STATE["template"],
+                filename,
+                WORKER_STATE["site"],
+                blog_posts=WORKER_STATE["blog_posts"],
+                update_timestamps=options["update_timestamps"],
+            )
+            return None, content, None
+
+        metadata = apply_template(
+            WORKER_STATE["template"],
+            filename,
+            WORKER_STATE["site"],
+            blog_posts=WORKER_STATE["blog_posts"],
+            **options
+        )
+    except Exception:
+        return traceback.format_exc(), None, None
+
+    return None, None, metadata
+
+
+def apply_serially(
+    template, site, blog_posts, files, options, tidier=None, verbose=False
+):
+    """
+    Apply a CompiledTemplate to files, returning a dictionary of errors and a
+    dictionary of the metadata returned by apply_template for each file
+    """
+
+    errors = {}
+    metadata = {}
+
+    for f in files:
+        if verbose:
+            logging.info("Applying %s to %s", template.filename, f)
+
+        try:
+            metadata[f] = apply_template(
+                template, f, site, blog_posts=blog_posts, tidier=tidier, **options
+            )
+        except Exception:
+            errors[f] = traceback.format_exc()
+
+    return errors, metadata
+
+
+def apply_in_parallel(
+    template_filename,
+    site,
+    blog_posts,
+    files,
+    options,
+    jobs,
+    tidier=None,
+    verbose=False,
+):
+    """apply_serially() using a pool of jobs worker processes"""
+
+    logging.info(
+        "Applying %s to %d files using %d processes",
+        template_filename,
+        len(files),
+        jobs,
+    )
+
+    errors = {}
+    metadata = {}
+
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_worker,
+        initargs=(site.config_filename, template_filename, blog_posts, options),
+    ) as pool:
+        futures = {pool.submit(apply_template_worker, f): f for f in files}
+
+        for future in as_completed(futures):
+            filename = futures[future]
+
+            try:
+                error, content, metadata[filename] = future.result()
+            except Exception:
+                # e.g. the worker process was killed
+                error, content = traceback.format_exc(), None
+
+            if error:
+                errors[filename] = error
+                continue
+
+            if content is not None:
+                tidier.submit(filename, content)
+
+            if verbose:
+                logging.info("Applied %s to %s", template_filename, filename)
+
+    return errors, metadata
+
+
+def get_fingerprints(template_filename, site, blog_posts, files, options):
+    """Return the render_fingerprint for each file which has been indexed"""
+
+    inputs = [
+        md5_file(template_filename),
+        md5_file(site.config_filename),
+        sorted(options.items()),
+    ]
+
+    pages = site.pages.get_pages([os.path.realpath(f) for f in files])
+
+    fingerprints = {}
+
+    for f in files:
+        page = pages.get(os.path.realpath(f))
+        if page is None:
+            fingerprints[f] = None
+        else:
+            fingerprints[f] = render_fingerprint(inputs, page, site, blog_posts)
+
+    return fingerprints
+
+
+def find_stale_files(site, files, fingerprints):
+    """
+    Return the files which need to be rendered because their inputs have
+    changed or they have been modified since they were last rendered
+    """
+
+    rendered = site.pages.get_rendered_files()
+
+    stale = []
+
+    for f in files:
+        record = rendered.get(os.path.realpath(f))
+
+        if (
+            record is None
+            or fingerprints[f] is None
+            or record.fingerprint != fingerprints[f]
+            or not os.path.exists(f)
+            or not record.matches(os.stat(f))
+        ):
+            stale.append(f)
+
+    return stale
+
+
+def record_rendered_files(site, files, fingerprints):
+    """Record the fingerprints of files which were successfully rendered"""
+
+    site.pages.record_rendered_files(
+        (os.path.realpath(f),) + RenderedFile.from_stat(os.stat(f), fingerprints[f])
+        for f in files
+        if fingerprints[f] is not None
+    )
+
+
+def record_rendered_posts(
+    site, template_filename, blog_posts, files, options, metadata=None
+):
+    """
+    Reindex files which were successfully rendered and record their
+    fingerprints, returning a PostIndex of the updated blog posts
+
+    Applying the template changes the metadata the fingerprints use, e.g. by
+    adding missing timestamps, so they're calculated from the reindexed files
+    or the next build would render every new post again. The files were
+    rendered using the neighbours in blog_posts so fingerprints are only
+    recorded if the reindexed posts have the same neighbours; any others will
+    be rendered again by the next build.
+
+    metadata is the dictionary returned by apply_serially or
+    apply_in_parallel, which avoids parsing the files again.
+    """
+
+    if not files:
+        return blog_posts
+
+    metadata = metadata or {}
+
+    site.pages.index_files(
+        [os.path.realpath(f) for f in files],
+        metadata={
+            os.path.realpath(f): metadata[f]
+            for f in files
+            if metadata.get(f) is not None
+        },
+    )
+
+    posts = PostIndex(site.pages.get_blog_posts())
+
+    fingerprints = get_fingerprints(template_filename, site, posts, files, options)
+    rendered_with = get_fingerprints(
+        template_filename, site, blog_posts, files, options
+    )
+
+    record_rendered_files(
+        site, [f for f in files if fingerprints[f] == rendered_with[f]], fingerprints
+    )
+
+    return posts
 
 
 class ApplyTemplate(Command):
@@ -40,6 +278,20 @@ class ApplyTemplate(Command):
             default="_templates/post.html",
             help="Template filename (default: %(default)s)",
         )
+        parser.add_argument(
+            "--force",
+            default=False,
+            action="store_true",
+            help="Update files even if nothing they depend on has changed",
+        )
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            default=1,
+            help="Number of processes used to update files; 0 uses one per CPU"
+            " (default: %(default)s)",
+        )
         return parser
 
     def take_action(self, args):
@@ -52,22 +304,80 @@ class ApplyTemplate(Command):
             )
 
         site = load_site()
-        blog_posts = site.pages.get_blog_posts()
+
+        blog_posts = list(site.pages.get_blog_posts())
 
         if not args.all_posts:
             files = args.files
         else:
             files = [i.filename for i in blog_posts]
 
-        for f in files:
-            if args.verbose:
-                logging.info("Applying %s to %s", args.template, f)
+        # Built once so finding the neighbours for each post is O(log n):
+        blog_posts = PostIndex(blog_posts)
 
-            apply_template(
+        options = {"tidy_html": args.tidy, "update_timestamps": args.update_timestamps}
+
+        fingerprints = get_fingerprints(args.template, site, blog_posts, files, options)
+
+        # New timestamps change the output every time:
+        if not (args.force or args.update_timestamps):
+            stale = find_stale_files(site, files, fingerprints)
+            logging.info(
+                "%d of %d files are up to date", len(files) - len(stale), len(files)
+            )
+            files = stale
+
+        if not files:
+            return
+
+        jobs = args.jobs or os.cpu_count() or 1
+
+        # Tidying runs concurrently with rendering:
+        tidier = Tidier(site.pages.get_tidied_files()) if args.tidy else None
+
+        if jobs > 1 and len(files) > 1:
+            errors, metadata = apply_in_parallel(
                 args.template,
-                f,
                 site,
-                blog_posts=blog_posts,
-                tidy_html=args.tidy,
-                update_timestamps=args.update_timestamps,
+                blog_posts,
+                files,
+                options,
+                jobs,
+                tidier=tidier,
+                verbose=args.verbose,
+            )
+        else:
+            errors, metadata = apply_serially(
+                CompiledTemplate(args.template),
+                site,
+                blog_posts,
+                files,
+                options,
+                tidier=tidier,
+                verbose=args.verbose,
+            )
+
+        if tidier is not None:
+            tidied, tidy_errors = tidier.close()
+            site.pages.record_tidied_files(tidied)
+            errors.update(tidy_errors)
+
+        record_rendered_posts(
+            site,
+            args.template,
+            blog_posts,
+            [f for f in files if f not in errors],
+            options,
+            metadata=metadata,
+        )
+
+        for filename, error in sorted(errors.items()):
+            logging.error(
+                "Unable to apply %s to %s:\n%s", args.template, filename, error
+            )
+
+        if errors:
+            raise RuntimeError(
+                "Unable to apply the template to %d of %d files"
+                % (len(errors), len(files))
             )
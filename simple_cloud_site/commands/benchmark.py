@@ -0,0 +1,135 @@
+# encoding: utf-8
+"""Benchmark publishing a synthetic site to an in-memory container
+
+This runs the publish command against MemoryStorageDriver so upload path
+performance can be measured without a cloud account. Each run reports the
+wall time, requests issued and bytes sent for an initial publish, a publish
+with no changes and a publish after modifying some of the files.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import time
+import uuid
+from tempfile import TemporaryDirectory
+
+from cliff.lister import Lister
+
+from simple_cloud_site.commands.publish import Publish
+from simple_cloud_site.storage import MEMORY_STORES
+
+SITE_CONFIG = """[site]
+container = benchmark
+base_url = http://localhost/
+
+[publish]
+provider = memory
+store = %(store)s
+latency = %(latency)f
+"""
+
+
+def make_synthetic_site(base_dir, file_count, file_size, store, latency):
+    with open(os.path.join(base_dir, ".simple-cloud-site.cfg"), "w") as f:
+        f.write(SITE_CONFIG % {"store": store, "latency": latency})
+
+    filenames = []
+
+    for i in range(file_count):
+        # Spread the files across directories like a real site:
+        filename = os.path.join(base_dir, "assets", "%03d" % (i // 100), "%05d.dat" % i)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(os.urandom(file_size))
+        filenames.append(filename)
+
+    return filenames
+
+
+class BenchmarkPublish(Lister):
+    def get_description(self):
+        return __doc__
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "--files",
+            type=int,
+            default=1000,
+            help="Number of files in the synthetic site (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--file-size",
+            type=int,
+            default=16384,
+            help="Size of each file in bytes (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.02,
+            help="Simulated seconds per storage request (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--modified",
+            type=float,
+            default=0.1,
+            help="Fraction of files changed before the final run"
+            " (default: %(default)s)",
+        )
+        parser.add_argument(
+            "publish_args",
+            nargs="*",
+            metavar="PUBLISH_ARG",
+            help="Additional publish options, e.g. -- --upload-workers 16",
+        )
+        return parser
+
+    def take_action(self, args):
+        store_name = uuid.uuid4().hex
+        store = MEMORY_STORES[store_name]
+
+        publish = Publish(self.app, self.app_args, cmd_name="publish")
+        publish_args = publish.get_parser("publish").parse_args(args.publish_args)
+
+        results = []
+
+        old_cwd = os.getcwd()
+
+        try:
+            with TemporaryDirectory() as base_dir:
+                filenames = make_synthetic_site(
+                    base_dir, args.files, args.file_size, store_name, args.latency
+                )
+
+                os.chdir(base_dir)
+
+                def run(label):
+                    requests, bytes_sent = store.requests, store.bytes_sent
+                    start = time.monotonic()
+                    publish.take_action(publish_args)
+                    elapsed = time.monotonic() - start
+                    bytes_sent = store.bytes_sent - bytes_sent
+                    results.append(
+                        (
+                            label,
+                            round(elapsed, 3),
+                            store.requests - requests,
+                            bytes_sent,
+                            round(bytes_sent / elapsed / 1048576, 2),
+                        )
+                    )
+
+                run("initial")
+                run("unchanged")
+
+                for filename in filenames[: int(len(filenames) * args.modified)]:
+                    with open(filename, "ab") as f:
+                        f.write(b"\0")
+
+                run("modified")
+        finally:
+            os.chdir(old_cwd)
+            MEMORY_STORES.pop(store_name, None)
+
+        return (("Run", "Wall time (s)", "Requests", "Bytes sent", "MB/s"), results)
@@ -0,0 +1,78 @@
+# encoding: utf-8
+"""Update the posts, index, archives and feeds in a single pass
+
+This is equivalent to running apply-template --all-posts, update-indices and
+generate-feeds but the site is only indexed once, the templates are only
+parsed once and the updated posts are indexed from the documents which were
+written, without parsing them again, so the index and feeds use the updated
+posts.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+
+from cliff.command import Command
+
+from simple_cloud_site.commands.watch import IncrementalBuilder
+from simple_cloud_site.search import update_search_index
+from simple_cloud_site.site import load_site
+
+
+class Build(Command):
+    def get_description(self):
+        return __doc__
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "--template",
+            default="_templates/post.html",
+            help="Template filename (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--tidy",
+            default=False,
+            action="store_true",
+            help="Tidy HTML using tidy-html5 (https://github.com/w3c/tidy-html5)",
+        )
+        parser.add_argument(
+            "--search",
+            default=False,
+            action="store_true",
+            help="Also update the search index (see search-index)",
+        )
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            default=1,
+            help="Number of processes used to update posts; 0 uses one per CPU"
+            " (default: %(default)s)",
+        )
+        return parser
+
+    def take_action(self, args):
+        if not os.path.exists(args.template):
+            raise RuntimeError("Template file %s does not exist" % args.template)
+
+        site = load_site()
+
+        builder = IncrementalBuilder(
+            site,
+            template=args.template,
+            tidy_html=args.tidy,
+            jobs=args.jobs or os.cpu_count() or 1,
+        )
+        builder.build()
+
+        if args.search:
+            output_dir = os.path.join(
+                site.base_dir, site.config.get("search", "directory", fallback="search")
+            )
+            update_search_index(site, output_dir)
+
+        if builder.errors:
+            raise RuntimeError(
+                "Unable to apply the template to %d files: %s"
+                % (len(builder.errors), ", ".join(sorted(builder.errors)))
+            )
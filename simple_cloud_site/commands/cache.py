@@ -0,0 +1,44 @@
+# encoding: utf-8
+"""Maintain the local cache database
+
+report: display statistics about the cache (default)
+vacuum: update query statistics and reclaim unused space
+rebuild: discard everything and reindex the site
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+
+from cliff.show import ShowOne
+
+from simple_cloud_site.site import load_site
+
+
+class Cache(ShowOne):
+    def get_description(self):
+        return __doc__
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "action",
+            nargs="?",
+            choices=["report", "vacuum", "rebuild"],
+            default="report",
+        )
+        return parser
+
+    def take_action(self, args):
+        site = load_site()
+
+        # Rebuilding will reindex everything so there's no point doing it first:
+        cache = site.get_page_cache(index=args.action != "rebuild")
+
+        if args.action == "rebuild":
+            logging.info("Rebuilding %s", cache.db_file)
+            cache.rebuild()
+        elif args.action == "vacuum":
+            logging.info("Vacuuming %s", cache.db_file)
+            cache.vacuum()
+
+        return tuple(zip(*cache.get_statistics()))
@@ -4,54 +4,370 @@
 This is intended to preview a local static HTML site during development. It
 extends the default ``python -m http.server`` behaviour with several extensions:
 
-1. Cache-Control headers will be sent to avoid browser caching
-2. Minified media will be replaced with uncompressed counterparts if present to avoid needing to alter
-   templates for more convenient development:
+1. Cache-Control headers require browsers to revalidate every request but
+   files have ETag and Last-Modified validators so unchanged files receive a
+   304 Not Modified response
+2. Minified media will be replaced with uncompressed counterparts if present
+   to avoid needing to alter templates for more convenient development:
     * Requests for *.min.css will be treated as requests for *.css
     * Requests for *.min.js will be treated as requests for *.js
+3. Requests are handled concurrently using HTTP/1.1 persistent connections
+4. With --watch, posts, the index and feeds are rebuilt as files change
+5. With --cache-size, files are served from an in-memory LRU cache which also
+   holds gzipped copies of text files for clients which accept them. Cache
+   statistics are available at /_devserver/stats
 """
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import json
 import os
 import re
-from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+from collections import Counter, OrderedDict, namedtuple
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import Lock, Thread
 
 from cliff.command import Command
 
 from simple_cloud_site import VERSION
+from simple_cloud_site.commands.watch import IncrementalBuilder
+from simple_cloud_site.compression import gzip_compress, is_compressible
+from simple_cloud_site.site import load_site
 
 DEMINIFY_RE = re.compile(r"[.]min[.](css|js)$")
 
+STATS_PATH = "/_devserver/stats"
+
+
+def make_etag(st, encoding=None):
+    etag = "%x-%x-%x" % (st.st_ino, st.st_mtime_ns, st.st_size)
+    # Each representation needs a different entity tag:
+    if encoding:
+        etag += "-" + encoding
+    return '"%s"' % etag
+
+
+def accepts_gzip(accept_encoding):
+    """Return whether an Accept-Encoding header allows gzip"""
+
+    if not accept_encoding:
+        return False
+
+    qualities = {}
+
+    for i in accept_encoding.split(","):
+        coding, _, params = i.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    return qualities.get("gzip", qualities.get("*", 0)) > 0
+
+
+class CachedFile(namedtuple("CachedFile", ["st", "content_type", "data", "gzip_data"])):
+    __slots__ = ()
+
+    @property
+    def signature(self):
+        return (self.st.st_ino, self.st.st_mtime_ns, self.st.st_size)
+
+
+class ResponseCache(object):
+    """
+    Thread-safe LRU cache of file contents and their gzipped versions
+
+    Entries are checked against the file's inode, mtime and size on every
+    request so edits are served immediately. The total size of the cached
+    data is limited to max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = Counter()
+
+    @staticmethod
+    def entry_size(entry):
+        return len(entry.data) + len(entry.gzip_data or b"")
+
+    def get(self, filename, content_type):
+        """Return a CachedFile for filename, reading it if necessary"""
+
+        st = os.stat(filename)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        with self.lock:
+            entry = self.entries.get(filename)
+
+            if entry is not None:
+                if entry.signature == signature:
+                    self.entries.move_to_end(filename)
+                    self.stats["hits"] += 1
+                    return entry
+
+                self.remove(filename)
+                self.stats["invalidations"] += 1
+
+            self.stats["misses"] += 1
+
+        # Other requests can be served while the file is read and compressed:
+        with open(filename, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+
+        gzip_data = gzip_compress(data) if is_compressible(content_type) else None
+
+        entry = CachedFile(st, content_type, data, gzip_data)
+        size = self.entry_size(entry)
+
+        if size > self.max_bytes:
+            return entry
+
+        with self.lock:
+            if filename in self.entries:
+                self.remove(filename)
+
+            self.entries[filename] = entry
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+        return entry
+
+    def remove(self, filename):
+        # The caller must hold the lock
+        self.size -= self.entry_size(self.entries.pop(filename))
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+            for i in ("hits", "misses", "invalidations", "evictions", "gzipped"):
+                stats[i] = self.stats[i]
+        return stats
+
+    def record(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
 
 class DevRequestHandler(SimpleHTTPRequestHandler):
     server_version = "simple-cloud-site/%s" % VERSION
 
+    # Keep-alive requires HTTP/1.1 and every response to have a Content-Length,
+    # which the base class already sends:
+    protocol_version = "HTTP/1.1"
+
+    # The requested path when it was overridden by apply_overrides:
+    old_path = None
+
     def send_response(self, code, message=None):
         super().send_response(code, message=message)
 
         self.send_header("Cache-Control", "private, no-cache, must-revalidate")
 
-        if code == 200 and hasattr(self, "old_path") and self.old_path != self.path:
+        if code == 200 and self.old_path and self.old_path != self.path:
             self.send_header("Content-Location", self.path)
             self.send_header(
                 "X-Content-Location-Notice",
                 "served {0.path} for {0.old_path}".format(self),
             )
 
-    def do_GET(self, *args, **kwargs):
+    def apply_overrides(self):
+        # The handler is reused for every request on a persistent connection:
+        self.old_path = self.path
+
         new_path, count = DEMINIFY_RE.subn(r".\1", self.path)
-        if count and os.path.exists(new_path):
+        if count and os.path.exists(self.translate_path(new_path)):
             self.log_message("Override: %s ➟ %s" % (self.path, new_path))
-            self.old_path = self.path
             self.path = new_path
 
+    def do_GET(self, *args, **kwargs):
+        # This must run first so a previous request's override isn't reported:
+        self.apply_overrides()
+
+        if self.path == STATS_PATH:
+            return self.send_stats()
+
         return super().do_GET(*args, **kwargs)
 
+    def send_stats(self):
+        cache = self.server.response_cache
+
+        stats = {"cache_enabled": cache is not None}
+        if cache is not None:
+            stats.update(cache.get_stats())
 
-def run_server(address, port):
-    httpd = TCPServer((address, port), DevRequestHandler)
+        body = json.dumps(stats, indent=4, sort_keys=True).encode("utf-8")
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self, *args, **kwargs):
+        self.apply_overrides()
+        return super().do_HEAD(*args, **kwargs)
+
+    def send_head(self):
+        """
+        Send the headers for a file, or a 304 response if the client's copy is
+        current, returning the open file for the body
+
+        Directories, missing files and other errors are handled by the base
+        class.
+        """
+
+        path = self.translate_path(self.path)
+
+        if self.path.endswith("/") or not os.path.isfile(path):
+            return super().send_head()
+
+        if self.server.response_cache is not None:
+            return self.send_cached_head(path)
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return super().send_head()
+
+        try:
+            st = os.fstat(f.fileno())
+            etag = make_etag(st)
+
+            if self.is_not_modified(st, etag):
+                f.close()
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return None
+
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(st.st_size))
+            self.send_header("Last-Modified", formatdate(st.st_mtime, usegmt=True))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def send_cached_head(self, path):
+        """send_head() using the response cache, returning the body as BytesIO"""
+
+        cache = self.server.response_cache
+
+        try:
+            entry = cache.get(path, self.guess_type(path))
+        except OSError:
+            return super().send_head()
+
+        if entry.gzip_data is not None and accepts_gzip(
+            self.headers.get("Accept-Encoding")
+        ):
+            encoding, body = "gzip", entry.gzip_data
+        else:
+            encoding, body = None, entry.data
+
+        etag = make_etag(entry.st, encoding)
+
+        if self.is_not_modified(entry.st, etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            if entry.gzip_data is not None:
+                self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return None
+
+        if encoding:
+            cache.record("gzipped")
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", entry.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", formatdate(entry.st.st_mtime, usegmt=True))
+        self.send_header("ETag", etag)
+        if entry.gzip_data is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+
+        return BytesIO(body)
+
+    def is_not_modified(self, st, etag):
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [i.strip() for i in if_none_match.split(",")]
+            # Weak comparison is used for conditional GET and HEAD requests:
+            tags = [i[2:] if i.startswith("W/") else i for i in tags]
+            return "*" in tags or etag in tags
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, IndexError, OverflowError, ValueError):
+                return False
+
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+
+            # HTTP dates only have one second resolution:
+            return int(st.st_mtime) <= since.timestamp()
+
+        return False
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, BytesIO):
+            outputfile.write(source.getbuffer())
+        else:
+            # socket.sendfile() uses os.sendfile() where available so the file
+            # contents are copied to the socket by the kernel:
+            self.connection.sendfile(source)
+
+
+class DevHTTPServer(ThreadingHTTPServer):
+    # Slow clients or idle persistent connections shouldn't prevent shutdown:
+    daemon_threads = True
+
+    # A ResponseCache, if enabled:
+    response_cache = None
+
+
+def watch_site(polling=False):
+    # The site is loaded in this thread since SQLite connections can only be
+    # used by the thread which created them:
+    IncrementalBuilder(load_site()).watch(polling=polling)
+
+
+def run_server(address, port, watch=False, polling=False, cache_size=0):
+    httpd = DevHTTPServer((address, port), DevRequestHandler)
+
+    if cache_size:
+        httpd.response_cache = ResponseCache(cache_size * 1024 * 1024)
+
+    if watch:
+        Thread(target=watch_site, args=(polling,), daemon=True).start()
 
     print("Serving %s at http://%s:%s/" % (os.getcwd(), address, port))
     httpd.serve_forever()
@@ -69,7 +385,34 @@ class DevServer(Command):
         parser.add_argument(
             "--port", type=int, default=8000, help="Local server port number"
         )
+        parser.add_argument(
+            "--watch",
+            default=False,
+            action="store_true",
+            help="Rebuild posts, the index and feeds when files change",
+        )
+        parser.add_argument(
+            "--poll",
+            default=False,
+            action="store_true",
+            help="With --watch, check for changes periodically instead of using"
+            " inotify",
+        )
+        parser.add_argument(
+            "--cache-size",
+            type=int,
+            default=0,
+            metavar="MB",
+            help="Serve files from an in-memory cache of this size, including"
+            " gzipped copies of text files (default: disabled)",
+        )
         return parser
 
     def take_action(self, args):
-        run_server(args.address, args.port)
+        run_server(
+            args.address,
+            args.port,
+            watch=args.watch,
+            polling=args.poll,
+            cache_size=args.cache_size,
+        )
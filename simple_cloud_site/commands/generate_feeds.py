@@ -1,45 +1,133 @@
 # encoding: utf-8
 from __future__ import absolute_import, print_function, unicode_literals
 
+import os
 from urllib.parse import urljoin
+from warnings import warn
 
 from cliff.command import Command
 
-from simple_cloud_site.feeds import FeedMaker
+from simple_cloud_site.feeds import (
+    FEED_MAX_ENTRIES,
+    SITEMAP_MAX_URLS,
+    FeedMaker,
+    write_sitemaps,
+)
 from simple_cloud_site.site import load_site
 
 
-class GenerateFeeds(Command):
-    """Generate sitemap.xml and RSS and Atom feeds"""
+def generate_feeds(site, gzip_sitemap=None, sitemap_max_urls=SITEMAP_MAX_URLS):
+    """
+    Write the sitemap and the RSS and Atom feeds for a site, returning the
+    filenames which were written
 
-    def take_action(self, parsed_args):
-        site = load_site()
+    The sitemap is the only part which needs every page. It is streamed from
+    the cache, and the feeds only load the posts they list.
+    """
+
+    site_info = {
+        "site_url": site.base_url,
+        "site_title": site.config.get("site", "site_title"),
+        "site_description": site.config.get("site", "site_description"),
+        "author_name": site.config.get("author", "name"),
+        "author_email": site.config.get("author", "email"),
+    }
+
+    # This is equivalent to urljoin(site.base_url, path) for the absolute paths
+    # returned by Site.filename_to_url but much faster for the entire site:
+    origin = urljoin(site.base_url, "/").rstrip("/")
+
+    if gzip_sitemap is None:
+        gzip_sitemap = site.config.getboolean("feeds", "gzip_sitemap", fallback=False)
+
+    # The Atom feed's updated time is the latest modification of any page,
+    # which is found while streaming the sitemap:
+    latest = None
+
+    def sitemap_entries():
+        nonlocal latest
+        for url, date_modified in get_sitemap_entries(site, origin):
+            latest = max(latest or date_modified, date_modified)
+            yield url, date_modified
+
+    written = write_sitemaps(
+        sitemap_entries(),
+        site.base_dir,
+        site.base_url,
+        compress=gzip_sitemap,
+        max_urls=sitemap_max_urls,
+    )
+
+    feed_maker = FeedMaker(site_info, updated=latest)
+
+    for post in site.pages.get_recently_modified_posts():
+        path = site.filename_to_url(post.filename)
+
+        if path == "/":
+            continue  # Skip the index page
 
-        site_info = {
-            "site_url": site.base_url,
-            "site_title": site.config.get("site", "site_title"),
-            "site_description": site.config.get("site", "site_description"),
-            "author_name": site.config.get("author", "name"),
-            "author_email": site.config.get("author", "email"),
-        }
+        feed_maker.add_page(origin + path, post)
 
-        feed_maker = FeedMaker(site_info)
+        if len(feed_maker.pages) >= FEED_MAX_ENTRIES:
+            break
 
-        for page in site.pages.get_all_pages():
-            path = site.filename_to_url(page.filename)
+    feeds_dir = os.path.join(site.base_dir, "feeds")
 
-            if path == "/":
-                continue  # Skip the index page
+    rss_filename = os.path.join(feeds_dir, "all.rss")
+    with open(rss_filename, "wb") as f:
+        feed_maker.generate_rss(f)
 
-            url = urljoin(site.base_url, path)
+    atom_filename = os.path.join(feeds_dir, "all.atom")
+    with open(atom_filename, "wb") as f:
+        feed_maker.generate_atom(f)
 
-            feed_maker.add_page(url, page)
+    return written + [rss_filename, atom_filename]
 
-        with open("sitemap.xml", "wb") as f:
-            feed_maker.generate_sitemap(f)
 
-        with open("feeds/all.rss", "wb") as f:
-            feed_maker.generate_rss(f)
+def get_sitemap_entries(site, origin):
+    """Yield (url, last_modified) for the pages included in the sitemap"""
 
-        with open("feeds/all.atom", "wb") as f:
-            feed_maker.generate_atom(f)
+    for filename, title, date_modified in site.pages.get_page_dates():
+        path = site.filename_to_url(filename)
+
+        if path == "/":
+            continue  # Skip the index page
+
+        if not title:
+            warn("Skipping %s: missing title" % (origin + path))
+            continue
+
+        if not date_modified:
+            warn("Skipping %s: missing last modified timestamp" % (origin + path))
+            continue
+
+        yield origin + path, date_modified
+
+
+class GenerateFeeds(Command):
+    """Generate sitemap.xml and RSS and Atom feeds"""
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "--gzip-sitemap",
+            default=None,
+            action="store_true",
+            help="Write sitemap.xml.gz instead of sitemap.xml"
+            " (default: [feeds] gzip_sitemap or false)",
+        )
+        parser.add_argument(
+            "--sitemap-max-urls",
+            type=int,
+            default=SITEMAP_MAX_URLS,
+            help="Split the sitemap into files with at most this many URLs"
+            " (default: %(default)s)",
+        )
+        return parser
+
+    def take_action(self, parsed_args):
+        generate_feeds(
+            load_site(),
+            gzip_sitemap=parsed_args.gzip_sitemap,
+            sitemap_max_urls=parsed_args.sitemap_max_urls,
+        )
@@ -1,98 +1,429 @@
 # encoding: utf-8
-"""Generate index.html file"""
+"""Generate index.html and the archive, year and keyword pages"""
 # FIXME: recursively update subdirectories
 from __future__ import absolute_import, print_function, unicode_literals
 
+import glob
+import json
 import logging
+import math
+import os
+import re
+from collections import OrderedDict, namedtuple
+from copy import deepcopy
+from hashlib import sha256
+from itertools import chain
 
 from cliff.command import Command
+from lxml.etree import SubElement
 from lxml.html import tostring
 from pyquery import PyQuery
 
-from simple_cloud_site.html import html_from_string, lxml_inner_html, parse_html, tidy
+from simple_cloud_site.commands.apply_template import record_rendered_files
+from simple_cloud_site.files import md5_file
+from simple_cloud_site.html import Tidier, html_from_string, parse_html
 from simple_cloud_site.site import load_site
+from simple_cloud_site.utils import chunked
 
 
-class UpdateIndices(Command):
-    def get_description(self):
-        return __doc__
+def fill_post_list(site, template, posts, bodies=True):
+    """
+    Replace the placeholder entry in the template's .post-list with one for
+    each post, including the full text of each post unless bodies is False
+    """
 
-    def get_parser(self, prog_name):
-        parser = super().get_parser(prog_name)
-        parser.add_argument(
-            "--tidy",
-            default=False,
-            action="store_true",
-            help="Tidy HTML using tidy-html5 (https://github.com/w3c/tidy-html5)",
-        )
-        return parser
+    post_list = template.find(".post-list").removeClass("placeholder")
+    post_template = post_list.children().eq(0).clone().removeClass("placeholder")
+    post_list.empty()
 
-    def take_action(self, args):
-        site = load_site()
+    for post in posts:
+        p = post_template.clone()
+
+        uri = site.filename_to_url(post.filename)
+
+        p.find("a.title").removeClass("placeholder").attr("href", uri).text(post.title)
+
+        post_date = post.get_publication_date()
+        p.find(".date").removeClass("placeholder").text(
+            post_date.strftime("%b %d")
+        ).attr("datetime", post_date.isoformat())
+
+        # The cached summary and body already have absolute links:
+        if post.summary is not None:
+            p.find(".summary").removeClass("placeholder").html(post.summary)
+        else:
+            p.find(".summary").remove()
+
+        if bodies:
+            # Work around https://github.com/gawel/pyquery/issues/31 by correctly
+            # parsing Unicode into an HTML Element instance rather than passing in
+            # the text directly.
+            body = p.find(".body").removeClass("placeholder").empty()
+            for i in PyQuery(html_from_string(post.articleBody)).contents():
+                if isinstance(i, str):
+                    # Work around https://github.com/gawel/pyquery/issues/32 by forcing
+                    # lxml.etree._ElementUnicodeResult into str:
+                    i = str(i)
+                body.append(i)
+        else:
+            p.find(".body").remove()
+
+        p.appendTo(post_list)
+
+
+def load_template(filename, documents=None):
+    """
+    Return a copy of a parsed template, reusing the document parsed by an
+    earlier call with the same documents dictionary
+    """
+
+    if documents is None:
+        documents = {}
+
+    if filename not in documents:
+        logging.debug("Loading %s", filename)
+        documents[filename] = parse_html(filename)
 
-        logging.info("Updating indices under %s", site.base_dir)
+    return deepcopy(documents[filename])
 
-        logging.debug("Loading recent posts")
-        recent_posts = site.pages.get_recent_posts(4)
 
-        logging.debug("Loading _templates/index.html")
-        # TODO: read template name from a config file
-        template = PyQuery(parse_html("_templates/index.html").getroot())
+def update_index(site, tidy_html=False, documents=None):
+    """
+    Regenerate the site's index.html using the most recent posts, returning
+    its filename
 
-        template.find("title").text(site.config.get("site", "site_title"))
+    Pass the same documents dictionary to update_index and update_archives to
+    share parsed templates between them.
+    """
 
-        post_list = template.find(".post-list").removeClass("placeholder")
-        post_template = post_list.children().eq(0).clone().removeClass("placeholder")
-        post_list.empty()
+    # TODO: read template name from a config file
+    template_filename = os.path.join(site.base_dir, "_templates", "index.html")
+    index_filename = os.path.join(site.base_dir, "index.html")
 
-        for post in recent_posts:
-            p = post_template.clone()
+    logging.info("Updating indices under %s", site.base_dir)
 
-            uri = site.filename_to_url(post.filename)
+    logging.debug("Loading recent posts")
+    recent_posts = [i.filename for i in site.pages.get_recent_posts(4)]
+    contents = site.pages.get_pages(recent_posts, content=True)
+    recent_posts = [contents[i] for i in recent_posts]
 
-            html = post.html.getroot()
-            html.make_links_absolute(uri)
+    template = PyQuery(load_template(template_filename, documents).getroot())
 
-            p.find("a.title").removeClass("placeholder").attr("href", uri).text(
-                post.title
+    template.find("title").text(site.config.get("site", "site_title"))
+
+    fill_post_list(site, template, recent_posts)
+
+    orphans = template.find(".placeholder")
+    if orphans:
+        logging.error("Template contained unexpanded placeholders: %s", orphans)
+
+    # We don't use template.outerHtml because that would lose the doctype
+    content = tostring(template[0].getroottree(), method="html", encoding="utf-8")
+
+    if tidy_html:
+        # This avoids running tidy when the posts haven't changed:
+        tidier = Tidier(site.pages.get_tidied_files(), workers=1)
+        tidier.submit(index_filename, content)
+        tidied, errors = tidier.close()
+        site.pages.record_tidied_files(tidied)
+
+        if errors:
+            raise RuntimeError(
+                "Unable to tidy %s:\n%s" % (index_filename, errors[index_filename])
             )
+    else:
+        logging.info("Replacing index.html")
+        with open(index_filename, "wb") as f:
+            f.write(content)
+
+    return index_filename
+
+
+# Included in the archive page fingerprints so existing pages are rendered
+# again when render_archive_page changes what it writes:
+ARCHIVE_RENDER_VERSION = 2
+
+ArchivePage = namedtuple(
+    "ArchivePage", ["filename", "heading", "posts", "previous", "next"]
+)
+
+
+# Symbols which distinguish keywords such as C, C++ and C# are spelled out in
+# their slugs rather than being treated as punctuation:
+SLUG_SYMBOLS = {"+": "plus", "#": "sharp", "&": "and", "@": "at"}
+
+
+def slugify(value):
+    value = "".join(
+        "-%s-" % SLUG_SYMBOLS[i] if i in SLUG_SYMBOLS else i for i in value.lower()
+    )
+    return re.sub(r"[\W_]+", "-", value).strip("-")
+
+
+def get_archive_pages(site, archive_dir, per_page):
+    """
+    Generator which returns an ArchivePage for each page of the archive and
+    for each year and keyword
+
+    Archive pages are numbered from the oldest post so adding a post only
+    changes the newest pages rather than moving every post to the next page.
+    The newest page is the archive's index.html.
+    """
+
+    # Posts without a publication date can't be placed in the archive:
+    page_count = math.ceil(site.pages.get_blog_post_count(dated=True) / per_page)
+
+    def page_filename(number):
+        if number == page_count:
+            return os.path.join(archive_dir, "index.html")
+        else:
+            return os.path.join(archive_dir, "page-%d.html" % number)
+
+    for number, posts in enumerate(
+        chunked(site.pages.get_blog_posts(dated=True), per_page), 1
+    ):
+        yield ArchivePage(
+            page_filename(number),
+            "Archive" if number == page_count else "Archive: page %d" % number,
+            posts,
+            page_filename(number - 1) if number > 1 else None,
+            page_filename(number + 1) if number < page_count else None,
+        )
+
+    for year, count in site.pages.get_blog_post_years():
+        yield ArchivePage(
+            os.path.join(archive_dir, "%d.html" % year),
+            "Posts from %d" % year,
+            list(site.pages.get_blog_posts_by_year(year)),
+            None,
+            None,
+        )
+
+    # Keywords which only differ by case or punctuation share a page, using
+    # the most common spelling as its title. See SLUG_SYMBOLS for the
+    # characters which aren't treated as punctuation:
+    keywords = OrderedDict()
+    for keyword, count in site.pages.get_keywords():
+        slug = slugify(keyword)
+        if slug:
+            keywords.setdefault(slug, []).append((count, keyword))
+
+    for slug, spellings in keywords.items():
+        yield ArchivePage(
+            os.path.join(archive_dir, "keywords", "%s.html" % slug),
+            "Posts tagged %s" % max(spellings)[1],
+            list(site.pages.get_blog_posts_by_keyword(i for _, i in spellings)),
+            None,
+            None,
+        )
+
+
+def archive_fingerprint(inputs, page, site):
+    """
+    Return a hash of everything render_archive_page uses for page so it's only
+    rendered again when its own posts change
+    """
+
+    fields = [
+        inputs,
+        page.heading,
+        [site.filename_to_url(i) if i else None for i in (page.previous, page.next)],
+        [
+            (
+                site.filename_to_url(post.filename),
+                post.title,
+                post.get_publication_date(),
+                post.content_md5,
+            )
+            for post in page.posts
+        ],
+        archive_modification_date(page),
+    ]
+
+    return sha256(json.dumps(fields, default=str).encode("utf-8")).hexdigest()
 
-            post_date = post.get_publication_date()
-            p.find(".date").removeClass("placeholder").text(
-                post_date.strftime("%b %d")
-            ).attr("datetime", post_date.isoformat())
 
-            summary = html.cssselect(".summary")
-            if summary:
-                p.find(".summary").removeClass("placeholder").html(
-                    lxml_inner_html(summary[0]).strip()
+def archive_modification_date(page):
+    """Return the latest publication or modification date of the page's posts"""
+
+    dates = [
+        i
+        for post in page.posts
+        for i in (post.date_modified, post.get_publication_date())
+        if i is not None
+    ]
+    return max(dates) if dates else None
+
+
+def render_archive_page(site, document, page):
+    """Return the content of an ArchivePage using a parsed template document"""
+
+    template = PyQuery(deepcopy(document).getroot())
+
+    template.find("title").text(
+        "%s – %s" % (page.heading, site.config.get("site", "site_title"))
+    )
+    template.find(".archive-title").removeClass("placeholder").text(page.heading)
+
+    # The newest posts are listed first:
+    fill_post_list(site, template, reversed(page.posts), bodies=False)
+
+    # Pages need a modification date to be included in the sitemap. This is
+    # only looked for in <head> since the listed posts have their own:
+    date_modified = archive_modification_date(page)
+    if date_modified is not None:
+        slot = template("head").find('*[itemprop="dateModified"]')
+        if not slot:
+            slot = PyQuery(
+                [
+                    SubElement(i, "meta", itemprop="dateModified")
+                    for i in template("head")
+                ]
+            )
+        slot.attr(
+            "datetime" if slot.is_("time") else "content", date_modified.isoformat()
+        )
+
+    nav = template.find("#archive-nav")
+    if not (page.previous or page.next):
+        nav.remove()
+    else:
+        nav.removeClass("placeholder")
+        for cls, filename in (("previous", page.previous), ("next", page.next)):
+            link = nav.find(".%s" % cls)
+            if filename:
+                link.removeClass("placeholder").attr(
+                    "href", site.filename_to_url(filename)
                 )
             else:
-                p.find(".summary").remove()
+                link.remove()
 
-            # Work around https://github.com/gawel/pyquery/issues/31 by correctly parsing Unicode
-            # into an HTML Element instance rather than passing in the text directly.
-            body = p.find(".body").removeClass("placeholder").empty()
-            for i in PyQuery(html_from_string(post.articleBody)).contents():
-                if isinstance(i, str):
-                    # Work around https://github.com/gawel/pyquery/issues/32 by forcing
-                    # lxml.etree._ElementUnicodeResult into str:
-                    i = str(i)
-                body.append(i)
+    orphans = template.find(".placeholder")
+    if orphans:
+        logging.error("Template contained unexpanded placeholders: %s", orphans)
 
-            p.appendTo(post_list)
+    return tostring(template[0].getroottree(), method="html", encoding="utf-8")
 
-        orphans = template.find(".placeholder")
-        if orphans:
-            logging.error("Template contained unexpanded placeholders: %s", orphans)
 
-        logging.info("Replacing index.html")
-        with open("index.html", "wb") as f:
-            # We don't use template.outerHtml because that would lose the doctype
-            f.write(
-                tostring(template[0].getroottree(), method="html", encoding="utf-8")
-            )
+def update_archives(site, tidy_html=False, documents=None):
+    """
+    Regenerate the archive, year and keyword pages whose posts have changed
+
+    Pages are written to the [indices] archive_dir directory using
+    _templates/archive.html, or _templates/index.html if that doesn't exist.
+    Pages for years and keywords which no longer have any posts are removed.
+    Returns the filenames which were written or removed.
+    """
+
+    config = site.config
+
+    archive_dir = os.path.join(
+        site.base_dir, config.get("indices", "archive_dir", fallback="archives")
+    )
+    per_page = config.getint("indices", "posts_per_page", fallback=20)
+
+    template_filename = os.path.join(site.base_dir, "_templates", "archive.html")
+    if not os.path.exists(template_filename):
+        template_filename = os.path.join(site.base_dir, "_templates", "index.html")
+
+    inputs = [
+        ARCHIVE_RENDER_VERSION,
+        md5_file(template_filename),
+        md5_file(site.config_filename),
+    ]
+
+    logging.info("Updating archives under %s", archive_dir)
+
+    rendered = site.pages.get_rendered_files()
+
+    tidier = Tidier(site.pages.get_tidied_files()) if tidy_html else None
+
+    document = None
+    expected = set()
+    fingerprints = {}
+
+    for page in get_archive_pages(site, archive_dir, per_page):
+        expected.add(page.filename)
+
+        fingerprint = archive_fingerprint(inputs, page, site)
+
+        record = rendered.get(os.path.realpath(page.filename))
+        if (
+            record is not None
+            and record.fingerprint == fingerprint
+            and os.path.exists(page.filename)
+            and record.matches(os.stat(page.filename))
+        ):
+            continue
 
-        if args.tidy:
-            logging.info("Tidying index.html")
-            tidy("index.html")
+        if document is None:
+            document = load_template(template_filename, documents)
+
+        # The summaries are only loaded for the pages which are rendered:
+        contents = site.pages.get_pages([i.filename for i in page.posts], content=True)
+        page = page._replace(posts=[contents[i.filename] for i in page.posts])
+
+        content = render_archive_page(site, document, page)
+
+        os.makedirs(os.path.dirname(page.filename), exist_ok=True)
+
+        if tidier is not None:
+            tidier.submit(page.filename, content)
+        else:
+            logging.info("Saving %s", page.filename)
+            with open(page.filename, "wb") as f:
+                f.write(content)
+
+        fingerprints[page.filename] = fingerprint
+
+    if tidier is not None:
+        tidied, errors = tidier.close()
+        site.pages.record_tidied_files(tidied)
+
+        for filename, error in sorted(errors.items()):
+            logging.error("Unable to tidy %s:\n%s", filename, error)
+            del fingerprints[filename]
+
+    record_rendered_files(site, list(fingerprints), fingerprints)
+
+    removed = []
+
+    for filename in chain(
+        glob.glob(os.path.join(archive_dir, "index.html")),
+        glob.glob(os.path.join(archive_dir, "page-[0-9]*.html")),
+        glob.glob(os.path.join(archive_dir, "[0-9][0-9][0-9][0-9].html")),
+        glob.glob(os.path.join(archive_dir, "keywords", "*.html")),
+    ):
+        if filename not in expected:
+            logging.info("Removing %s", filename)
+            os.unlink(filename)
+            removed.append(filename)
+
+    logging.info(
+        "Updated %d of %d archive pages, removed %d",
+        len(fingerprints),
+        len(expected),
+        len(removed),
+    )
+
+    return sorted(fingerprints) + removed
+
+
+class UpdateIndices(Command):
+    def get_description(self):
+        return __doc__
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "--tidy",
+            default=False,
+            action="store_true",
+            help="Tidy HTML using tidy-html5 (https://github.com/w3c/tidy-html5)",
+        )
+        return parser
+
+    def take_action(self, args):
+        site = load_site()
+        update_index(site, tidy_html=args.tidy)
+        update_archives(site, tidy_html=args.tidy)
@@ -1,37 +1,106 @@
 # encoding: utf-8
-"""Publish the local directory"""
+"""Publish the local directory
+
+Publishing runs as a pipeline: the directory walk feeds a pool of hashing
+threads for files which have changed since they were last hashed, which in
+turn feed a pool of upload threads. Each stage runs concurrently with bounded
+queues between them so the network isn't idle while files are being hashed.
+"""
 from __future__ import absolute_import, print_function, unicode_literals
 
 import logging
 import mimetypes
 import os
-from configparser import RawConfigParser
-from hashlib import md5
-from queue import Queue
-from threading import Thread
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from queue import Full, Queue
+from threading import Event, Lock, Thread, current_thread
 
 from cliff.command import Command
+from libcloud.storage.drivers.cloudfiles import CloudFilesStorageDriver
+from libcloud.storage.drivers.s3 import BaseS3StorageDriver
 from libcloud.storage.providers import get_driver
-from libcloud.storage.types import ContainerDoesNotExistError, Provider
+from libcloud.storage.types import ContainerDoesNotExistError
 
-from simple_cloud_site.files import find_files
+from simple_cloud_site.compression import (
+    ENCODINGS,
+    CompressedArtifacts,
+    is_compressible,
+)
+from simple_cloud_site.files import md5_file, scan_files
+from simple_cloud_site.site import (
+    CompressedFile,
+    FileRecord,
+    PublishedObject,
+    load_site,
+)
+from simple_cloud_site.storage import MemoryStorageDriver
 
-CLOUDFILES = get_driver(Provider.CLOUDFILES_US)
+DEFAULT_PROVIDER = "cloudfiles_us"
 
+COMPRESSED_CACHE_DIR = ".simple-cloud-site-compressed"
 
-def get_driver_instance(config, container_name):
+# Sentinel used to tell pipeline workers that there is no more work:
+STOP = object()
+
+# Seconds between checks for failed workers while waiting for a full queue:
+QUEUE_POLL_INTERVAL = 0.1
+
+# Drivers whose listings report an ETag which is the MD5 of the object content,
+# unless it was uploaded in multiple parts:
+CONTENT_MD5_DRIVERS = (
+    BaseS3StorageDriver,
+    CloudFilesStorageDriver,
+    MemoryStorageDriver,
+)
+
+MD5_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def create_driver(config):
     """
-    Wrapper to safely get a driver
+    Create a libcloud storage driver using the [publish] provider setting
 
-    This allows us to use the non-thread-safe libcloud within a thread pool
+    In addition to any libcloud storage provider name, this accepts "memory"
+    for the in-process MemoryStorageDriver, which can simulate per-request
+    latency using the [publish] latency setting (in seconds). The "local"
+    provider stores files under the directory in the [publish] path setting.
     """
 
-    driver = CLOUDFILES(
-        config.get("auth", "username"),
-        config.get("auth", "api-key"),
-        ex_force_service_region=config.get("auth", "region"),
+    provider = config.get("publish", "provider", fallback=DEFAULT_PROVIDER).lower()
+
+    if provider == "memory":
+        return MemoryStorageDriver(
+            latency=config.getfloat("publish", "latency", fallback=0),
+            store=config.get("publish", "store", fallback="default"),
+        )
+
+    driver_class = get_driver(provider)
+
+    if provider == "local":
+        return driver_class(config.get("publish", "path"))
+
+    kwargs = {}
+    if config.has_option("auth", "region"):
+        if provider.startswith("cloudfiles"):
+            kwargs["ex_force_service_region"] = config.get("auth", "region")
+        else:
+            kwargs["region"] = config.get("auth", "region")
+
+    return driver_class(
+        config.get("auth", "username"), config.get("auth", "api-key"), **kwargs
     )
 
+
+def get_driver_instance(config, container_name):
+    """
+    Return a driver and the container, creating the container if necessary
+    """
+
+    driver = create_driver(config)
+
     try:
         container = driver.get_container(container_name=container_name)
     except ContainerDoesNotExistError:
@@ -43,82 +112,435 @@ def get_driver_instance(config, container_name):
     return driver, container
 
 
-def upload_worker(i, q, config, container_name):
-    driver, container = get_driver_instance(config, container_name)
+def reconcile_listing(driver, objects, manifest):
+    """
+    Convert a container listing into PublishedObjects for the publish manifest
+
+    Listed hashes are only used if they are content MD5s: other drivers, such
+    as the local driver, report values which will never match a local file. For
+    those the manifest hash is kept if the size hasn't changed and anything
+    else will be uploaded again.
+    """
+
+    trusted = isinstance(driver, CONTENT_MD5_DRIVERS)
+
+    for i in objects:
+        content_type = i.extra.get("content_type")
+
+        if trusted and MD5_RE.match((i.hash or "").lower()):
+            yield PublishedObject(i.name, i.hash.lower(), i.size, content_type)
+            continue
+
+        known = manifest.get(i.name)
+        if known and known.size == i.size:
+            yield PublishedObject(i.name, known.hash, i.size, content_type)
+        else:
+            yield PublishedObject(i.name, None, i.size, content_type)
+
+
+class TransferStats(object):
+    """Thread-safe counters used to report pipeline throughput"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = Counter()
+        self.started = time.monotonic()
+
+    def add(self, **kwargs):
+        with self.lock:
+            self.counters.update(kwargs)
+
+    def report(self, hash_queue, upload_queue):
+        with self.lock:
+            counters = self.counters.copy()
+
+        elapsed = max(time.monotonic() - self.started, 0.001)
+
+        logging.info(
+            "Scanned %d files; hashed %d files (%.1f MB/s); uploaded %d files"
+            " (%.1f files/s, %.1f MB/s); queued: %d to hash, %d to upload",
+            counters["scanned"],
+            counters["hashed"],
+            counters["hashed_bytes"] / elapsed / 1048576,
+            counters["uploaded"],
+            counters["uploaded"] / elapsed,
+            counters["uploaded_bytes"] / elapsed / 1048576,
+            hash_queue.qsize(),
+            upload_queue.qsize(),
+        )
+
+
+def put(q, item, failed):
+    """
+    Add an item to a bounded queue, raising an exception instead of waiting
+    forever if a pipeline worker has failed
+    """
 
     while True:
-        kwargs = q.get()
-        logging.info("Uploading %(object_name)s", kwargs)
-        driver.upload_object(container=container, **kwargs)
-        q.task_done()
+        if failed.is_set():
+            raise RuntimeError("Publishing stopped because a worker failed")
+        try:
+            q.put(item, timeout=QUEUE_POLL_INTERVAL)
+        except Full:
+            continue
+        return
+
+
+def run_worker(failed, target, *args):
+    """
+    Run a pipeline worker, setting the failed event if it stops because of an
+    unexpected exception so the other stages don't wait for it forever
+    """
+
+    try:
+        target(*args)
+    except Exception:
+        # Workers stopped by put() after another failure have nothing to add:
+        if not failed.is_set():
+            logging.exception("Publishing worker %s failed", current_thread().name)
+        failed.set()
+
+
+def hash_worker(hash_queue, hashed, publish_file, stats):
+    while True:
+        item = hash_queue.get()
+        if item is STOP:
+            return
+
+        filename, st = item
+
+        try:
+            record = FileRecord.from_stat(st, md5_file(filename))
+        except OSError:
+            logging.exception("Unable to hash %s", filename)
+            continue
+
+        stats.add(hashed=1, hashed_bytes=record.size)
+
+        hashed.put((filename,) + record)
+
+        publish_file(filename, record)
+
+
+def upload_worker(q, results, config, container, stats, artifacts, compressed_files):
+    # Each thread needs its own driver since libcloud isn't thread-safe. The
+    # container was already checked by the main thread:
+    driver = create_driver(config)
+
+    while True:
+        item = q.get()
+        if item is STOP:
+            return
+
+        kwargs, published_object, remote_hash, compress = item
+
+        try:
+            if compress:
+                # The manifest and remote hashes are for the compressed content,
+                # which may already be present if only the local cache was lost:
+                path = artifacts.get(kwargs["file_path"], published_object.hash)
+                compressed = CompressedFile(md5_file(path), os.path.getsize(path))
+                compressed_files.put(
+                    (published_object.hash, artifacts.encoding) + compressed
+                )
+
+                published_object = published_object._replace(
+                    hash=compressed.md5, size=compressed.size
+                )
+
+                if compressed.md5 == remote_hash:
+                    results.put(published_object)
+                    continue
+
+                kwargs = dict(
+                    kwargs,
+                    file_path=path,
+                    headers={"Content-Encoding": artifacts.encoding},
+                )
+
+            logging.info("Uploading %(object_name)s", kwargs)
+            driver.upload_object(container=container, **kwargs)
+        except Exception:
+            # This will be retried on the next run since it won't be recorded:
+            logging.exception("Unable to upload %(object_name)s", kwargs)
+        else:
+            stats.add(uploaded=1, uploaded_bytes=published_object.size)
+            results.put(published_object)
+
+
+def progress_reporter(done, interval, stats, hash_queue, upload_queue):
+    while not done.wait(interval):
+        stats.report(hash_queue, upload_queue)
+
+
+def drain(q):
+    """Return everything currently in a queue which is no longer being filled"""
+    return [q.get() for i in range(q.qsize())]
 
 
 class Publish(Command):
     def get_description(self):
         return __doc__
 
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "--verify-remote",
+            default=False,
+            action="store_true",
+            help="List the remote container instead of trusting the local record"
+            " of the last publish",
+        )
+        parser.add_argument(
+            "--compress",
+            choices=["none"] + sorted(ENCODINGS),
+            default=None,
+            help="Upload compressible files using this Content-Encoding"
+            " (default: [publish] compress or none)",
+        )
+        parser.add_argument(
+            "--hash-workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of threads used to hash changed files (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--upload-workers",
+            type=int,
+            default=8,
+            help="Number of concurrent uploads (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=1000,
+            help="Maximum number of files waiting for each stage"
+            " (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=float,
+            default=5,
+            help="Seconds between throughput reports (default: %(default)s)",
+        )
+        return parser
+
     def take_action(self, parsed_args):
-        config = RawConfigParser()
         # FIXME: support running outside of the site root
         # FIXME: enforce mode 600!
-        config.read([".simple-cloud-site.cfg"])
+        site = load_site()
+        config = site.config
 
-        source_dir = os.path.realpath(os.curdir)
+        # Publishing only needs the file hashes and the manifest, so this
+        # doesn't parse every page the way site.pages would:
+        pages = site.get_page_cache(index=False)
+
+        source_dir = site.base_dir
 
-        # TODO: allow provider configuration
         container_name = config.get("site", "container")
 
         logging.info("Publishing %s to %s", source_dir, container_name)
 
         driver, container = get_driver_instance(config, container_name)
 
-        upload_queue = Queue()
+        if self.needs_verification(parsed_args, site, pages, container_name):
+            logging.info("Listing the contents of %s", container_name)
+            pages.replace_published_objects(
+                container_name,
+                reconcile_listing(
+                    driver,
+                    container.list_objects(),
+                    pages.get_published_objects(container_name),
+                ),
+            )
 
-        workers = [
-            Thread(target=upload_worker, args=(i, upload_queue, config, container_name))
-            for i in range(8)
-        ]
+        remote_objects = pages.get_published_objects(container_name)
+
+        # Hashes are cached and only recalculated for files which have changed:
+        cached_files = pages.get_file_records()
+
+        encoding = parsed_args.compress or config.get(
+            "publish", "compress", fallback="none"
+        )
+
+        if encoding != "none":
+            artifacts = CompressedArtifacts(
+                os.path.join(source_dir, COMPRESSED_CACHE_DIR), encoding
+            )
+            known_compressed = pages.get_compressed_files(encoding)
+        else:
+            artifacts = None
+            known_compressed = {}
+
+        # Used to discard compressed copies of content which no longer exists:
+        local_hashes = set()
 
-        remote_objects = {i.name: i.hash for i in container.list_objects()}
+        stats = TransferStats()
+        hash_queue = Queue(maxsize=parsed_args.queue_size)
+        upload_queue = Queue(maxsize=parsed_args.queue_size)
+        hashed = Queue()
+        uploaded = Queue()
+        compressed_files = Queue()
 
-        for f in find_files(source_dir):
-            target_path = f.replace(source_dir, "").lstrip("/")
+        # Set by any worker which stops unexpectedly so the other stages don't
+        # wait forever for it:
+        failed = Event()
 
-            # TODO: load ignore list from site config
-            if target_path.endswith(".scss"):
-                continue
+        def publish_file(filename, record):
+            target_path = filename.replace(source_dir, "").lstrip("/")
 
-            if target_path in remote_objects:
-                # TODO: don't read the file twice:
-                with open(f, "rb") as local_file:
-                    h = md5()
-                    for chunk in iter(lambda: local_file.read(8192), b""):
-                        h.update(chunk)
-                    if h.hexdigest() == remote_objects[target_path]:
-                        continue
+            local_hashes.add(record.md5)
 
-            mime_type, encoding = mimetypes.guess_type(f)
+            mime_type, _ = mimetypes.guess_type(filename)
             if not mime_type:
                 mime_type = "application/octet-stream"
-            upload_queue.put(
-                {
-                    "object_name": target_path,
-                    "file_path": f,
-                    "extra": {"content_type": mime_type},
-                }
+
+            compress = artifacts is not None and is_compressible(mime_type)
+
+            if compress:
+                # If we haven't compressed this content before the upload worker
+                # will compress it and then compare the hash:
+                known = known_compressed.get(record.md5)
+                local_hash = known.md5 if known else None
+            else:
+                local_hash = record.md5
+
+            remote = remote_objects.get(target_path)
+            if (
+                remote
+                and remote.hash == local_hash
+                and remote.content_type in (None, mime_type)
+            ):
+                return
+
+            put(
+                upload_queue,
+                (
+                    {
+                        "object_name": target_path,
+                        "file_path": filename,
+                        "extra": {"content_type": mime_type},
+                    },
+                    PublishedObject(target_path, record.md5, record.size, mime_type),
+                    remote.hash if remote else None,
+                    compress,
+                ),
+                failed,
+            )
+
+        hashers = [
+            Thread(
+                target=run_worker,
+                args=(failed, hash_worker, hash_queue, hashed, publish_file, stats),
             )
+            for i in range(parsed_args.hash_workers)
+        ]
+
+        uploaders = [
+            Thread(
+                target=run_worker,
+                args=(
+                    failed,
+                    upload_worker,
+                    upload_queue,
+                    uploaded,
+                    config,
+                    container,
+                    stats,
+                    artifacts,
+                    compressed_files,
+                ),
+            )
+            for i in range(parsed_args.upload_workers)
+        ]
 
-        logging.info("Waiting for %d uploads to complete…", upload_queue.qsize())
+        done = Event()
+        reporter = Thread(
+            target=progress_reporter,
+            args=(done, parsed_args.progress_interval, stats, hash_queue, upload_queue),
+        )
 
-        for worker in workers:
-            worker.setDaemon(True)
+        for worker in hashers + uploaders + [reporter]:
+            worker.daemon = True
             worker.start()
 
-        upload_queue.join()
+        try:
+            # The stat() results from the walk are reused and the [files]
+            # ignore and include rules from the site configuration are applied:
+            for entry in scan_files(source_dir, site.file_rules):
+                f = entry.path
+                st = entry.stat()
+
+                stats.add(scanned=1)
+
+                record = cached_files.pop(f, None)
+
+                if record is not None and record.matches(st):
+                    publish_file(f, record)
+                else:
+                    put(hash_queue, (f, st), failed)
+
+            for worker in hashers:
+                put(hash_queue, STOP, failed)
+            for worker in hashers:
+                worker.join()
+
+            for worker in uploaders:
+                put(upload_queue, STOP, failed)
+            for worker in uploaders:
+                worker.join()
+        finally:
+            done.set()
+
+        stats.report(hash_queue, upload_queue)
+
+        # Nothing is recorded so everything will be checked again next time:
+        if failed.is_set():
+            raise RuntimeError("Publishing stopped because a worker failed")
+
+        pages.record_files(drain(hashed))
+        # Anything left over was not found during the walk:
+        pages.remove_files(cached_files)
+
+        pages.record_published_objects(container_name, drain(uploaded))
+
+        if artifacts:
+            pages.record_compressed_files(drain(compressed_files))
+            artifacts.prune(local_hashes)
+
+        # These are only available for providers which support static websites:
+        if hasattr(driver, "ex_enable_static_website"):
+            logging.info("Configuring static site…")
+            driver.ex_enable_static_website(
+                container=container, index_file="index.html"
+            )
+            driver.ex_set_error_page(container=container, file_name="error.html")
+            driver.enable_container_cdn(container=container)
+
+            print("CDN URL:", driver.get_container_cdn_url(container=container))
+
+    def needs_verification(self, args, site, pages, container_name):
+        """
+        Decide whether to reconcile the local publish manifest with a full
+        listing of the remote container
+
+        This happens on request, when there's no record of a previous listing
+        or when it is older than the optional [publish] verify_interval_days
+        """
+
+        if args.verify_remote:
+            return True
+
+        last_verified = pages.get_last_verified(container_name)
+        if not last_verified:
+            return True
+
+        interval = site.config.getfloat(
+            "publish", "verify_interval_days", fallback=None
+        )
 
-        logging.info("Configuring static site…")
-        driver.ex_enable_static_website(container=container, index_file="index.html")
-        driver.ex_set_error_page(container=container, file_name="error.html")
-        driver.enable_container_cdn(container=container)
+        if interval is not None:
+            age = datetime.now(timezone.utc) - last_verified
+            return age > timedelta(days=interval)
 
-        print("CDN URL:", driver.get_container_cdn_url(container=container))
+        return False
@@ -0,0 +1,42 @@
+# encoding: utf-8
+"""Build a static search index for the blog posts
+
+Only posts which have changed since the last run are tokenized again. The
+index is written to the [search] directory (default: search) in the site so
+it is published with everything else; see simple_cloud_site.search for the
+file format.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+
+from cliff.show import ShowOne
+
+from simple_cloud_site.search import update_search_index
+from simple_cloud_site.site import load_site
+
+
+class SearchIndex(ShowOne):
+    def get_description(self):
+        return __doc__
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "--rebuild",
+            default=False,
+            action="store_true",
+            help="Discard the existing index and tokenize every post",
+        )
+        return parser
+
+    def take_action(self, args):
+        site = load_site()
+
+        output_dir = os.path.join(
+            site.base_dir, site.config.get("search", "directory", fallback="search")
+        )
+
+        stats = update_search_index(site, output_dir, rebuild=args.rebuild)
+
+        return tuple(zip(*stats))
@@ -0,0 +1,373 @@
+# encoding: utf-8
+"""Rebuild posts, the index and feeds whenever files change
+
+Only the affected pages are reindexed. Posts are updated when they change or
+when the previous or next post changes, and every post is updated after the
+post template or site configuration changes. The index, archives and feeds
+are only regenerated when a blog post's metadata changes, or the sitemap when
+any page's title or modification date changes.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import os
+import time
+
+from cliff.command import Command
+
+from simple_cloud_site.commands.apply_template import (
+    apply_in_parallel,
+    apply_serially,
+    find_stale_files,
+    get_fingerprints,
+    record_rendered_posts,
+)
+from simple_cloud_site.commands.generate_feeds import generate_feeds
+from simple_cloud_site.commands.indices import update_archives, update_index
+from simple_cloud_site.html import Tidier
+from simple_cloud_site.site import PageRecord, PostIndex, load_site
+from simple_cloud_site.templates import CompiledTemplate
+from simple_cloud_site.watchers import EVERYTHING, get_watcher
+
+
+def changed_metadata(before, after):
+    """
+    Compare the PageCache.get_page_metadata() results from before and after
+    reindexing, returning whether any blog posts changed and whether the
+    sitemap needs to be updated
+    """
+
+    posts_changed = sitemap_changed = False
+
+    for filename in before.keys() | after.keys():
+        old, new = before.get(filename), after.get(filename)
+        if old == new:
+            continue
+
+        if any(i is not None and i["is_blog_post"] for i in (old, new)):
+            posts_changed = True
+
+        # The sitemap lists the title and modification date of every page:
+        entries = [(i["title"], i["date_modified"]) if i else None for i in (old, new)]
+        if entries[0] != entries[1]:
+            sitemap_changed = True
+
+    return posts_changed, sitemap_changed
+
+
+def get_signature(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class IncrementalBuilder(object):
+    """
+    Keeps a site's generated files up to date as its source files change
+
+    The same instance should be used for every change so it can compare the
+    previous and next posts before and after each change.
+    """
+
+    def __init__(self, site, template="_templates/post.html", tidy_html=False, jobs=1):
+        self.site = site
+        self.template_filename = os.path.join(site.base_dir, template)
+        self.templates_dir = os.path.join(site.base_dir, "_templates")
+        self.options = {"tidy_html": tidy_html, "update_timestamps": False}
+
+        # The number of processes used to apply the template:
+        self.jobs = jobs
+
+        self.template = None
+        self.posts = None
+
+        # Parsed templates shared by the index and archive pages:
+        self.documents = {}
+
+        # Tracebacks for the files which couldn't be rendered by the last build:
+        self.errors = {}
+
+        # The signatures of the files written by previous builds so the
+        # resulting change notifications can be ignored:
+        self.written = {}
+
+    def load_posts(self):
+        """
+        Load the PostIndex, returning it and the filenames of every blog post,
+        including those without a publication date which aren't indexed
+        """
+
+        blog_posts = list(self.site.pages.get_blog_posts())
+        self.posts = PostIndex(blog_posts)
+        return self.posts, [i.filename for i in blog_posts]
+
+    def neighbours(self, posts, filenames):
+        """Return the filenames of the posts next to each of filenames"""
+
+        if not posts:
+            return set()
+
+        dates = {i.filename: i.get_publication_date() for i in posts}
+
+        neighbours = set()
+        for filename in filenames:
+            if filename in dates:
+                neighbours.update(
+                    i.filename
+                    for i in posts.neighbours(dates[filename])
+                    if i is not None
+                )
+
+        return neighbours
+
+    def is_own_output(self, filename):
+        signature = self.written.get(filename)
+        return signature is not None and signature == get_signature(filename)
+
+    def build(self, changed=EVERYTHING):
+        """
+        Update everything which depends on the changed filenames
+
+        If changed is EVERYTHING the entire site is reindexed and every post
+        is checked.
+        """
+
+        started = time.monotonic()
+        parse_count = PageRecord.parse_count
+
+        site = self.site
+
+        self.errors = {}
+
+        if changed is EVERYTHING:
+            # Opening the cache indexes the site so this avoids a second walk:
+            if "pages" in site.__dict__:
+                site.pages.index_site()
+            self.template = None
+            self.documents.clear()
+            old_posts = None
+            pages = []
+            rebuild_all = True
+        else:
+            changed = {i for i in changed if not self.is_own_output(i)}
+
+            templates = {
+                i for i in changed if i.startswith(self.templates_dir + os.sep)
+            }
+
+            if site.config_filename in changed:
+                logging.info("Reloading %s", site.config_filename)
+                site.load_config()
+                templates.add(site.config_filename)
+
+            pages = sorted(i for i in changed - templates if i.endswith(".html"))
+
+            if not templates and not pages:
+                # Other files like stylesheets and images are used as-is:
+                return
+
+            if self.template_filename in templates:
+                self.template = None
+
+            if templates:
+                self.documents.clear()
+
+            old_posts = self.posts
+            before = site.pages.get_page_metadata(pages)
+            site.pages.index_files(pages)
+            rebuild_all = bool(templates)
+
+        # Applying the template adds the missing dates of undated posts:
+        posts, filenames = self.load_posts()
+
+        if rebuild_all:
+            candidates = filenames
+        else:
+            # Previous/next links change for the neighbours of any post which
+            # was added, removed or moved to a different date:
+            candidates = set(filenames).intersection(pages)
+            candidates.update(self.neighbours(old_posts, pages))
+            candidates.update(self.neighbours(posts, pages))
+            candidates = sorted(candidates)
+
+            # Applying the template can also change the metadata, e.g. by
+            # adding missing timestamps, and none of these have been reindexed:
+            before.update(site.pages.get_page_metadata(set(candidates) - set(pages)))
+
+        # The rendered posts are reindexed since the index, archives and feeds
+        # use the cached metadata and fragments:
+        rendered = self.render(candidates, posts)
+
+        if rebuild_all:
+            posts_changed = sitemap_changed = True
+        else:
+            posts_changed, sitemap_changed = changed_metadata(
+                before, site.pages.get_page_metadata(set(pages).union(candidates))
+            )
+
+        written = list(rendered)
+        updated = ["%d posts" % len(rendered)]
+
+        if posts_changed:
+            tidy_html = self.options["tidy_html"]
+            index_filename = update_index(site, tidy_html, documents=self.documents)
+            archives = update_archives(site, tidy_html, documents=self.documents)
+
+            # The index and archives are also pages which are listed in the
+            # sitemap:
+            site.pages.index_files([index_filename] + archives)
+
+            written += [index_filename] + archives
+            updated.append("the index and archives")
+
+        if posts_changed or sitemap_changed:
+            written += generate_feeds(site)
+            updated.append("the feeds")
+
+        for filename in written:
+            self.written[filename] = get_signature(filename)
+
+        if len(updated) > 1:
+            updated[-2:] = [" and ".join(updated[-2:])]
+
+        logging.info(
+            "Rebuilt %s in %.3f seconds",
+            ", ".join(updated),
+            time.monotonic() - started,
+        )
+
+        if PageRecord.parse_count > parse_count:
+            logging.info(
+                "Parsed %d pages for values which aren't cached",
+                PageRecord.parse_count - parse_count,
+            )
+
+    def render(self, candidates, posts):
+        """
+        Apply the template to the candidates which are stale and reindex them,
+        returning the filenames which were rendered
+        """
+
+        fingerprints = get_fingerprints(
+            self.template_filename, self.site, posts, candidates, self.options
+        )
+
+        stale = find_stale_files(self.site, candidates, fingerprints)
+
+        if self.options["tidy_html"]:
+            tidier = Tidier(self.site.pages.get_tidied_files())
+        else:
+            tidier = None
+
+        if self.jobs > 1 and len(stale) > 1:
+            errors, metadata = apply_in_parallel(
+                self.template_filename,
+                self.site,
+                posts,
+                stale,
+                self.options,
+                self.jobs,
+                tidier=tidier,
+            )
+        else:
+            if stale and self.template is None:
+                self.template = CompiledTemplate(self.template_filename)
+
+            errors, metadata = apply_serially(
+                self.template, self.site, posts, stale, self.options, tidier=tidier
+            )
+
+        if tidier is not None:
+            tidied, tidy_errors = tidier.close()
+            self.site.pages.record_tidied_files(tidied)
+            errors.update(tidy_errors)
+
+        for filename, error in sorted(errors.items()):
+            logging.error(
+                "Unable to apply %s to %s:\n%s", self.template_filename, filename, error
+            )
+
+        self.errors.update(errors)
+
+        rendered = [i for i in stale if i not in errors]
+
+        self.posts = record_rendered_posts(
+            self.site,
+            self.template_filename,
+            posts,
+            rendered,
+            self.options,
+            metadata=metadata,
+        )
+
+        return rendered
+
+    def watch(self, polling=False):
+        """Build the site and then rebuild it whenever files change"""
+
+        site = self.site
+
+        # This is created first so changes made during the build aren't missed:
+        watcher = get_watcher(site.base_dir, site.file_rules, polling=polling)
+
+        try:
+            changed = EVERYTHING
+
+            while True:
+                try:
+                    self.build(changed)
+                except Exception:
+                    logging.exception("Unable to rebuild %s", site.base_dir)
+
+                if watcher.rules is not site.file_rules:
+                    # The configuration was reloaded and its [files] rules may
+                    # include different files, which are all checked again:
+                    watcher.close()
+                    watcher = get_watcher(
+                        site.base_dir, site.file_rules, polling=polling
+                    )
+                    changed = EVERYTHING
+                else:
+                    changed = watcher.wait()
+        finally:
+            watcher.close()
+
+
+class Watch(Command):
+    def get_description(self):
+        return __doc__
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            "--template",
+            default="_templates/post.html",
+            help="Template filename (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--tidy",
+            default=False,
+            action="store_true",
+            help="Tidy HTML using tidy-html5 (https://github.com/w3c/tidy-html5)",
+        )
+        parser.add_argument(
+            "--poll",
+            default=False,
+            action="store_true",
+            help="Check for changes periodically instead of using inotify",
+        )
+        return parser
+
+    def take_action(self, args):
+        site = load_site()
+
+        builder = IncrementalBuilder(site, template=args.template, tidy_html=args.tidy)
+
+        logging.info("Watching %s for changes", site.base_dir)
+
+        try:
+            builder.watch(polling=args.poll)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,104 @@
+# encoding: utf-8
+"""Pre-compression of text files for publishing with Content-Encoding"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import gzip
+import logging
+import os
+from tempfile import NamedTemporaryFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    "application/atom+xml",
+    "application/javascript",
+    "application/json",
+    "application/rss+xml",
+    "application/x-rss+xml",
+    "application/xml",
+    "image/svg+xml",
+    "image/vnd.microsoft.icon",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+    "text/xml",
+}
+
+
+def gzip_compress(data):
+    # A fixed mtime keeps the output, and therefore its hash, stable:
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=11)
+
+
+# Content-Encoding: (file extension, compression function)
+ENCODINGS = {"gzip": (".gz", gzip_compress), "br": (".br", brotli_compress)}
+
+
+def is_compressible(content_type):
+    return content_type in COMPRESSIBLE_TYPES
+
+
+class CompressedArtifacts(object):
+    """
+    On-disk cache of compressed files keyed by the MD5 of the source content
+
+    Because the key is the content hash, unchanged files are never
+    recompressed and renaming or copying a file reuses the existing artifact.
+    """
+
+    def __init__(self, cache_dir, encoding):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unsupported content encoding: %s" % encoding)
+
+        if encoding == "br" and brotli is None:
+            raise RuntimeError(
+                "Brotli compression requires the brotli package: pip install brotli"
+            )
+
+        self.encoding = encoding
+        self.extension, self.compress = ENCODINGS[encoding]
+        self.cache_dir = os.path.join(cache_dir, encoding)
+
+    def path(self, source_md5):
+        return os.path.join(self.cache_dir, source_md5[:2], source_md5 + self.extension)
+
+    def get(self, filename, source_md5):
+        """Return the path of the compressed version of filename"""
+
+        path = self.path(source_md5)
+
+        if not os.path.exists(path):
+            logging.debug("Compressing %s using %s", filename, self.encoding)
+
+            with open(filename, "rb") as f:
+                data = self.compress(f.read())
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Multiple threads may compress identical files concurrently so the
+            # artifact is written to a temporary file and atomically renamed:
+            with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+
+        return path
+
+    def prune(self, source_md5s):
+        """Remove artifacts for content which is no longer in use"""
+
+        keep = {self.path(i) for i in source_md5s}
+
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                if path not in keep:
+                    logging.debug("Removing unused compressed file %s", path)
+                    os.unlink(path)
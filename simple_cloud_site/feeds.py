@@ -2,20 +2,219 @@
 # encoding: utf-8
 from __future__ import absolute_import, print_function, unicode_literals
 
-from collections import deque, namedtuple
+import glob
+import gzip
+import os
+from collections import namedtuple
 from email.utils import format_datetime
+from itertools import chain
 from urllib.parse import urljoin
 from warnings import warn
 
 from lxml import etree, objectify
+from lxml.etree import Element, SubElement
 
 FeedEntry = namedtuple("FeedEntry", ["last_modified", "url", "page"])
 
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+# The number of posts in the RSS and Atom feeds:
+FEED_MAX_ENTRIES = 10
+
+# Limits from https://www.sitemaps.org/protocol.html which apply to each file
+# before compression:
+SITEMAP_MAX_URLS = 50000
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+
+# A file is closed once it is this close to the size limit so the next entry
+# (URLs can be up to 2048 characters) and closing tag are guaranteed to fit:
+SITEMAP_RESERVED_BYTES = 16384
+
+
+class ByteCounter(object):
+    """File-like wrapper which counts the bytes written to it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.f.write(data)
+
+
+def sitemap_entry(tag, url, last_modified):
+    """
+    Return a url or sitemap element, indented to match the surrounding file
+
+    These are built without a namespace and written inside the root element,
+    which declares the sitemap namespace as the default, so each entry doesn't
+    repeat the declaration.
+    """
+
+    entry = Element(tag)
+    entry.text = "\n    "
+
+    child = SubElement(entry, "loc")
+    child.text = url
+
+    if last_modified:
+        child.tail = "\n    "
+        child = SubElement(entry, "lastmod")
+        child.text = last_modified.isoformat()
+
+    child.tail = "\n  "
+
+    return entry
+
+
+def write_urlset(
+    file_handle, entries, max_urls=SITEMAP_MAX_URLS, max_bytes=SITEMAP_MAX_BYTES
+):
+    """
+    Incrementally write (url, last_modified) entries as a sitemap urlset
+
+    Entries are consumed until the iterator is exhausted or the file reaches
+    the size or URL limits, leaving any remaining entries for the next file.
+    Returns the number of URLs written and the latest modification time.
+    """
+
+    out = ByteCounter(file_handle)
+    count = 0
+    latest = None
+
+    # This is unbuffered so the byte count is current after each entry:
+    with etree.xmlfile(out, encoding="utf-8", buffered=False) as xf:
+        xf.write_declaration()
+        with xf.element("{%s}urlset" % SITEMAP_NS, nsmap={None: SITEMAP_NS}):
+            for url, last_modified in entries:
+                xf.write("\n  ")
+                xf.write(sitemap_entry("url", url, last_modified))
+
+                if last_modified:
+                    latest = max(latest or last_modified, last_modified)
+
+                count += 1
+
+                if (
+                    count >= max_urls
+                    or out.bytes_written >= max_bytes - SITEMAP_RESERVED_BYTES
+                ):
+                    break
+
+            xf.write("\n")
+
+    out.write(b"\n")
+
+    return count, latest
+
+
+def write_sitemap_index(file_handle, sitemaps):
+    """Write a sitemap index for (url, last_modified) pairs"""
+
+    with etree.xmlfile(file_handle, encoding="utf-8") as xf:
+        xf.write_declaration()
+        with xf.element("{%s}sitemapindex" % SITEMAP_NS, nsmap={None: SITEMAP_NS}):
+            for url, last_modified in sitemaps:
+                xf.write("\n  ")
+                xf.write(sitemap_entry("sitemap", url, last_modified))
+            xf.write("\n")
+
+    file_handle.write(b"\n")
+
+
+def open_sitemap(filename, compress):
+    if compress:
+        # A fixed mtime means unchanged sitemaps won't be published again:
+        return gzip.GzipFile(filename, "wb", mtime=0)
+    else:
+        return open(filename, "wb")
+
+
+def write_sitemaps(
+    entries,
+    output_dir,
+    base_url,
+    compress=False,
+    max_urls=SITEMAP_MAX_URLS,
+    max_bytes=SITEMAP_MAX_BYTES,
+):
+    """
+    Stream (url, last_modified) entries into sitemap.xml
+
+    Memory use is constant regardless of the number of entries. If they don't
+    fit in a single file they are split into sitemap-1.xml, sitemap-2.xml, etc.
+    and sitemap.xml becomes a sitemap index listing them. With compress, every
+    file is gzipped and has a .xml.gz extension instead.
+
+    Returns the list of filenames written.
+    """
+
+    extension = ".xml.gz" if compress else ".xml"
+    index_filename = os.path.join(output_dir, "sitemap" + extension)
+
+    entries = iter(entries)
+    sitemaps = []
+
+    while True:
+        # Check for remaining entries so there's never an empty extra file:
+        first = next(entries, None)
+        if first is None and sitemaps:
+            break
+
+        filename = os.path.join(
+            output_dir, "sitemap-%d%s" % (len(sitemaps) + 1, extension)
+        )
+
+        with open_sitemap(filename, compress) as f:
+            count, latest = write_urlset(
+                f,
+                chain([first] if first is not None else [], entries),
+                max_urls=max_urls,
+                max_bytes=max_bytes,
+            )
+
+        sitemaps.append((filename, latest))
+
+    if len(sitemaps) == 1:
+        os.replace(sitemaps[0][0], index_filename)
+        written = [index_filename]
+    else:
+        with open_sitemap(index_filename, compress) as f:
+            write_sitemap_index(
+                f,
+                (
+                    (urljoin(base_url, os.path.basename(filename)), latest)
+                    for filename, latest in sitemaps
+                ),
+            )
+        written = [index_filename] + [filename for filename, latest in sitemaps]
+
+    # Remove files left over from previous runs with more entries or the other
+    # compression setting:
+    for filename in chain(
+        glob.glob(os.path.join(output_dir, "sitemap.xml*")),
+        glob.glob(os.path.join(output_dir, "sitemap-[0-9]*.xml*")),
+    ):
+        if filename not in written:
+            os.unlink(filename)
+
+    return written
+
 
 class FeedMaker(object):
-    def __init__(self, metadata):
-        self.pages = deque()
+    """
+    Generates the RSS and Atom feeds for the pages which are added
+
+    Only the pages which should be listed need to be added. updated is the
+    time the site was last modified, which is used for the Atom feed and
+    defaults to the latest modification of the added pages.
+    """
+
+    def __init__(self, metadata, updated=None):
+        self.pages = []
         self.metadata = metadata
+        self.updated = updated
 
     def add_page(self, url, page):
         if not page.title:
@@ -37,23 +236,6 @@ class FeedMaker(object):
 
         return self.blog_pages
 
-    def generate_sitemap(self, file_handle):
-        E = objectify.ElementMaker(
-            annotate=False,
-            namespace="http://www.sitemaps.org/schemas/sitemap/0.9",
-            nsmap={None: "http://www.sitemaps.org/schemas/sitemap/0.9"},
-        )
-
-        urlset = E.urlset()
-
-        for last_mod, url, page in self.pages:
-            url_elem = E.url(E.loc(url))
-            if last_mod:
-                url_elem.append(E.lastmod(page.date_modified.isoformat()))
-            urlset.append(url_elem)
-
-        file_handle.write(etree.tostring(urlset, pretty_print=True, encoding="utf-8"))
-
     def generate_rss(self, file_handle):
         E = objectify.ElementMaker(
             annotate=False, nsmap={"atom": "http://www.w3.org/2005/Atom"}
@@ -73,7 +255,7 @@ class FeedMaker(object):
             )
         )
 
-        for last_mod, url, page in self.get_blog_pages()[:10]:
+        for last_mod, url, page in self.get_blog_pages()[:FEED_MAX_ENTRIES]:
             item = E.item(
                 E.title(page.title), E.link(url), E.guid(url, isPermaLink="true")
             )
@@ -112,12 +294,14 @@ class FeedMaker(object):
             ),
         )
 
-        pages = sorted(self.pages, key=lambda i: i[0], reverse=True)
+        updated = self.updated
+        if updated is None and self.pages:
+            updated = max(i.page.date_modified for i in self.pages)
 
-        if pages:
-            feed.append(E.updated(pages[0][2].date_modified.isoformat()))
+        if updated is not None:
+            feed.append(E.updated(updated.isoformat()))
 
-        for last_mod, url, page in self.get_blog_pages()[:10]:
+        for last_mod, url, page in self.get_blog_pages()[:FEED_MAX_ENTRIES]:
             entry = E.entry(E.title(page.title), E.id(url), E.link(href=url))
 
             if page.description:
@@ -1,9 +1,13 @@
 # encoding: utf-8
 from __future__ import absolute_import, print_function, unicode_literals
 
+import fnmatch
 import os
+import re
+from hashlib import md5
 
 IGNORE_DIRECTORIES = [
+    ".simple-cloud-site-compressed",
     "_templates",
     ".git",
     ".hg",
@@ -20,29 +24,196 @@ IGNORE_DIRECTORIES = [
 ]
 
 
-def find_files(source_dir):
+# Files which are never part of the site, unless a rule in the site
+# configuration includes them:
+IGNORE_FILES = [".*", "*Makefile", "*.scss"]
+
+
+class PatternSet(object):
+    """
+    Glob patterns compiled into one regular expression per kind of test
+
+    Patterns use fnmatch syntax. Patterns ending with / only match directories
+    and patterns containing any other / are matched against the path relative
+    to the site directory rather than the name of the file or directory.
+    """
+
+    def __init__(self, patterns=(), directories=(), files=()):
+        self.patterns = {
+            (is_dir, anchored): []
+            for is_dir in (True, False)
+            for anchored in (True, False)
+        }
+
+        for pattern in patterns:
+            self.add(pattern)
+
+        for pattern in directories:
+            self.add(pattern, files=False)
+
+        for pattern in files:
+            self.add(pattern, directories=False)
+
+        self.compile()
+
+    def add(self, pattern, directories=True, files=True):
+        if pattern.endswith("/"):
+            pattern = pattern.rstrip("/")
+            files = False
+
+        anchored = "/" in pattern
+        regex = fnmatch.translate(pattern.lstrip("/"))
+
+        if directories:
+            self.patterns[True, anchored].append(regex)
+        if files:
+            self.patterns[False, anchored].append(regex)
+
+    def compile(self):
+        self.matchers = {
+            key: re.compile("|".join(regexes)).match if regexes else None
+            for key, regexes in self.patterns.items()
+        }
+
+    def match(self, name, path, is_dir):
+        """Return whether name, found at the relative path, matches any pattern"""
+
+        by_name = self.matchers[is_dir, False]
+        if by_name is not None and by_name(name):
+            return True
+
+        by_path = self.matchers[is_dir, True]
+        return by_path is not None and by_path(path) is not None
+
+
+class FileRules(object):
+    """
+    Decides which files are part of the site
+
+    The built-in ignore rules can be extended using the [files] section of the
+    site configuration, which takes whitespace-separated lists of patterns::
+
+        [files]
+        ignore = drafts/ *.psd
+        include = .well-known/ static/
+
+    Anything matching an include pattern is kept even if it matches an ignore
+    pattern. Files inside an ignored directory are always ignored.
+    """
+
+    def __init__(self, ignore=(), include=()):
+        self.ignore = PatternSet(
+            ignore, directories=IGNORE_DIRECTORIES, files=IGNORE_FILES
+        )
+        self.include = PatternSet(include)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            ignore=config.get("files", "ignore", fallback="").split(),
+            include=config.get("files", "include", fallback="").split(),
+        )
+
+    def is_excluded(self, name, path, is_dir=False):
+        return self.ignore.match(name, path, is_dir) and not self.include.match(
+            name, path, is_dir
+        )
+
+
+DEFAULT_RULES = FileRules()
+
+
+def scan_files(source_dir, rules=DEFAULT_RULES, relative_dir=""):
+    """Generator which returns an os.DirEntry for each file in source_dir
+
+    This uses os.scandir() so ignored directories are skipped without any
+    extra system calls and entry.stat() is only called once per file, after
+    which the result is cached by the entry. Ignored files (see FileRules) are
+    excluded.
+    """
+
+    subdirectories = []
+
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            path = relative_dir + entry.name
+
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+
+            if rules.is_excluded(entry.name, path, is_dir):
+                continue
+
+            if not is_dir:
+                if entry.is_file():
+                    yield entry
+            elif not entry.is_symlink():
+                subdirectories.append((entry.path, path + "/"))
+
+    for directory, path in subdirectories:
+        yield from scan_files(directory, rules, path)
+
+
+def find_files(source_dir, rules=DEFAULT_RULES):
     """Generator which returns filenames from source_dir
 
     The results will exclude:
-    * Makefiles
+    * Makefiles and SCSS sources
     * Any file which starts with .
     * Anything under a directory in IGNORE_DIRECTORIES
       (i.e. version control checkout data)
+    * Anything else ignored by rules
     """
-    for root, dirs, files in os.walk(source_dir):
-        for f in files:
-            if f.startswith(".") or f.endswith("Makefile"):
-                continue
+    for entry in scan_files(source_dir, rules):
+        yield entry.path
+
+
+def is_ignored(filename, source_dir, rules=DEFAULT_RULES):
+    """Return whether find_files(source_dir, rules) would exclude filename"""
 
-            yield os.path.join(root, f)
+    path = os.path.relpath(filename, source_dir)
+    if path.startswith(os.pardir + os.sep):
+        return True
 
-        for ignore in IGNORE_DIRECTORIES:
-            if ignore in dirs:
-                dirs.remove(ignore)
+    parts = path.split(os.sep)
 
+    for i, name in enumerate(parts[:-1]):
+        if rules.is_excluded(name, "/".join(parts[: i + 1]), is_dir=True):
+            return True
 
-def find_html_files(source_dir):
+    return rules.is_excluded(parts[-1], "/".join(parts))
+
+
+def find_html_files(source_dir, rules=DEFAULT_RULES):
     """Simple find_files() variant which only yields HTML files"""
-    for f in find_files(source_dir):
-        if os.path.isfile(f) and f.endswith(".html"):
-            yield f
+    for entry in scan_files(source_dir, rules):
+        if entry.name.endswith(".html"):
+            yield entry.path
+
+
+def md5_file(filename, chunk_size=1024 * 1024):
+    """Return the hex MD5 digest of a file's contents"""
+    h = md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StatRecord(object):
+    """
+    Mixin for namedtuples with size, inode and mtime_ns fields recording the
+    state of a file, used to tell whether it has changed since
+    """
+
+    __slots__ = ()
+
+    def matches(self, st):
+        """Return whether a stat result has the same size, inode and mtime"""
+        return (self.size, self.inode, self.mtime_ns) == (
+            st.st_size,
+            st.st_ino,
+            st.st_mtime_ns,
+        )
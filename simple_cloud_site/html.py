@@ -3,23 +3,35 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import logging
+import os
+import re
 import sys
+import traceback
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timezone
 from functools import wraps
-from subprocess import PIPE, Popen, check_call
+from hashlib import md5
+from subprocess import PIPE, Popen
+from threading import BoundedSemaphore
 
 from dateutil.parser import parse as parse_date
 from dateutil.tz import tzlocal
-from lxml.etree import XPath
+from lxml.cssselect import CSSSelector
+from lxml.etree import Element
 from lxml.html import HTMLParser
 from lxml.html import fromstring as _html_fromstring
 from lxml.html import parse as _html_parse
 from lxml.html import tostring
 
+from .files import StatRecord
 from .utils import cached_property
 
 UTF8_PARSER = HTMLParser(encoding="utf-8")
 
+# tzlocal() reads the system timezone configuration so this is only done once:
+LOCAL_TZ = tzlocal()
+
 
 def parse_html(file_like, **kwargs):
     """lxml.html.parse with UTF-8 compatibility
@@ -90,72 +102,244 @@ def normalize_timestamp(f):
             if timestamp.tzinfo:
                 timestamp = timestamp.astimezone(timezone.utc)
             else:
-                local_tz = tzlocal()
-                logging.warn(
+                logging.warning(
                     "last modified time did not specify timezone, assuming system: %s",
                     timestamp,
                 )
-                timestamp = timestamp.replace(tzinfo=local_tz)
+                timestamp = timestamp.replace(tzinfo=LOCAL_TZ)
 
         return timestamp
 
     return inner
 
 
-def get_first_xpath(xpaths, doc):
-    """Return the first element matched by the provided list of XPATH expressions"""
-    for i in xpaths:
-        res = i(doc)
-        if res:
-            return res[0]
+class ExtractionRule(
+    namedtuple("ExtractionRule", ["expression", "steps", "anchor", "source"])
+):
+    """
+    A compiled metadata extraction rule
 
+    Rules are written using a small subset of XPath so they can be checked
+    against each element during a single walk of the document instead of
+    running a separate query over the entire tree for every field::
 
-# TODO: Use custom xpath / CSS checks from config file?
-BLOG_POST_XPATHS = [
-    XPath(i) for i in ('/html/body[@itemtype="http://schema.org/BlogPosting"]',)
-]
-TITLE_XPATHS = [
-    XPath(i) for i in ('//*[@itemprop="title"]/text()', "head/title/text()")
-]
-DESCRIPTION_XPATHS = [
-    XPath(i)
-    for i in (
-        '//*[@itemprop="description"]/text()',
-        'head/meta[@name="description"]/@content',
-    )
-]
+        /html/body[@itemtype="http://schema.org/BlogPosting"]
+        head/meta[@name="description"]/@content
+        //time[@itemprop="datePublished"]/@datetime
+        //*[@itemprop="title"]/text()
 
-LAST_MODIFIED_XPATHS = [XPath('//meta[@http-equiv="last-modified"]/@content')]
+    Each location step may have a single ``[@attribute]`` or
+    ``[@attribute="value"]`` predicate and the expression may end with
+    ``/text()`` or ``/@attribute`` to return that value instead of the element.
+    """
 
-DATE_MODIFIED_XPATHS = [
-    XPath(i)
-    for i in (
-        '//time[@itemprop="dateModified"]/@datetime',
-        '//meta[@itemprop="dateModified"]/@content',
-    )
-]
-DATE_CREATED_XPATHS = [
-    XPath(i)
-    for i in (
-        '//time[@itemprop="dateCreated"]/@datetime',
-        '//meta[@itemprop="dateCreated"]/@content',
-    )
-]
-DATE_PUBLISHED_XPATHS = [
-    XPath(i)
-    for i in (
-        '//time[@itemprop="datePublished"]/@datetime',
-        '//meta[@itemprop="datePublished"]/@content',
-    )
-]
-TIMESTAMP_XPATHS = (
-    LAST_MODIFIED_XPATHS
-    + DATE_MODIFIED_XPATHS
-    + DATE_PUBLISHED_XPATHS
-    + DATE_CREATED_XPATHS
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, expression):
+        match = RULE_RE.match(expression)
+        if not match:
+            raise ValueError("Unsupported metadata expression: %s" % expression)
+
+        prefix, path, source = match.group("prefix", "path", "source")
+
+        steps = []
+        pos = 0
+        while pos < len(path):
+            step = RULE_STEP_RE.match(path, pos)
+            if not step:
+                raise ValueError("Unsupported metadata expression: %s" % expression)
+            steps.append(step.group("tag", "attribute", "value"))
+            pos = step.end()
+
+        anchor = {"//": None, "/": "document"}.get(prefix, "root")
+
+        return cls(expression, tuple(steps), anchor, source)
+
+    @property
+    def tag(self):
+        return self.steps[-1][0]
+
+    def matches(self, elem):
+        for tag, attribute, value in reversed(self.steps):
+            if elem is None:
+                return False
+            if tag != "*" and elem.tag != tag:
+                return False
+            if attribute:
+                actual = elem.get(attribute)
+                if actual is None or (value is not None and actual != value):
+                    return False
+            elem = elem.getparent()
+
+        if self.anchor == "document":
+            return elem is None
+        elif self.anchor == "root":
+            # Relative expressions are evaluated against the root element:
+            return elem is not None and elem.getparent() is None
+        else:
+            return True
+
+    def extract(self, elem):
+        """Return the selected value for a matching element or None"""
+
+        if not self.source:
+            return elem
+        elif self.source == "text()":
+            # As with XPath, this is the first text node even if it only
+            # contains whitespace:
+            if elem.text is not None:
+                return elem.text
+            for child in elem:
+                if child.tail is not None:
+                    return child.tail
+            return None
+        else:
+            return elem.get(self.source[1:])
+
+
+RULE_RE = re.compile(
+    r"^(?P<prefix>//|/)?(?P<path>.+?)(?:/(?P<source>text\(\)|@[\w:-]+))?$"
+)
+RULE_STEP_RE = re.compile(
+    r"""(?P<tag>[\w:-]+|\*)"""
+    r"""(?:\[@(?P<attribute>[\w:-]+)(?:=(?P<quote>["'])(?P<value>.*?)(?P=quote))?\])?"""
+    r"""(?:/(?=.)|$)"""
 )
 
 
+class MetadataExtractor(object):
+    """
+    Collect metadata fields from a document in a single pass
+
+    Rules are a mapping of field names to a list of expressions in priority
+    order. As with the XPath lists this replaces, the first expression which
+    matches anything wins and each expression returns its first match in
+    document order. The walk stops as soon as every requested field has been
+    found using its highest-priority expression.
+    """
+
+    def __init__(self, rules):
+        self.rules = OrderedDict()
+        self.rules_by_tag = defaultdict(list)
+        self.wildcard_rules = []
+
+        for field, expressions in rules.items():
+            compiled = [ExtractionRule.compile(i) for i in expressions]
+            self.rules[field] = compiled
+
+            for priority, rule in enumerate(compiled):
+                if rule.tag == "*":
+                    self.wildcard_rules.append((field, priority, rule))
+                else:
+                    self.rules_by_tag[rule.tag].append((field, priority, rule))
+
+    def extend(self, field, expressions):
+        """Return a new extractor which checks expressions before the defaults"""
+
+        rules = OrderedDict(
+            (k, [rule.expression for rule in v]) for k, v in self.rules.items()
+        )
+        rules[field] = list(expressions) + rules.get(field, [])
+
+        return self.__class__(rules)
+
+    def extract(self, doc, fields=None):
+        """Return a dictionary of the requested fields, using None if not found"""
+
+        if fields is None:
+            fields = list(self.rules)
+
+        results = dict.fromkeys(fields)
+
+        # The priority of the best match so far for each unfinished field:
+        pending = {i: len(self.rules[i]) for i in fields}
+
+        root = doc.getroot() if hasattr(doc, "getroot") else doc
+
+        for elem in root.iter(tag=Element):
+            candidates = self.rules_by_tag.get(elem.tag)
+            if candidates:
+                candidates = candidates + self.wildcard_rules
+            else:
+                candidates = self.wildcard_rules
+
+            for field, priority, rule in candidates:
+                if pending.get(field, 0) <= priority or not rule.matches(elem):
+                    continue
+
+                value = rule.extract(elem)
+                if value is None:
+                    continue
+
+                results[field] = value
+
+                if priority == 0:
+                    del pending[field]
+                else:
+                    pending[field] = priority
+
+            if not pending:
+                break
+
+        return results
+
+
+# Sites can add their own rules using METADATA_EXTRACTOR.extend():
+METADATA_RULES = OrderedDict(
+    [
+        ("is_blog_post", ['/html/body[@itemtype="http://schema.org/BlogPosting"]']),
+        ("title", ['//*[@itemprop="title"]/text()', "head/title/text()"]),
+        (
+            "description",
+            [
+                '//*[@itemprop="description"]/text()',
+                'head/meta[@name="description"]/@content',
+            ],
+        ),
+        ("last_modified", ['//meta[@http-equiv="last-modified"]/@content']),
+        (
+            "date_modified",
+            [
+                '//time[@itemprop="dateModified"]/@datetime',
+                '//meta[@itemprop="dateModified"]/@content',
+            ],
+        ),
+        (
+            "date_created",
+            [
+                '//time[@itemprop="dateCreated"]/@datetime',
+                '//meta[@itemprop="dateCreated"]/@content',
+            ],
+        ),
+        (
+            "date_published",
+            [
+                '//time[@itemprop="datePublished"]/@datetime',
+                '//meta[@itemprop="datePublished"]/@content',
+            ],
+        ),
+        ("articleBody", ['//*[@itemprop="articleBody"]']),
+        (
+            "keywords",
+            [
+                '//*[@itemprop="keywords"]/@content',
+                '//*[@itemprop="keywords"]/text()',
+                'head/meta[@name="keywords"]/@content',
+            ],
+        ),
+    ]
+)
+
+METADATA_EXTRACTOR = MetadataExtractor(METADATA_RULES)
+
+SUMMARY_SELECTOR = CSSSelector(".summary")
+
+
+def parse_timestamp(value):
+    return parse_date(value) if value else None
+
+
 class Page(object):
     def __init__(self, filename_or_doc, filename=None):
         if filename:
@@ -193,6 +377,10 @@ class Page(object):
     def html(self):
         return parse_html(self.filename)
 
+    @cached_property
+    def metadata(self):
+        return METADATA_EXTRACTOR.extract(self.html)
+
     @property
     def href(self):
         # BUG: decide how we're going to normalize these!
@@ -200,40 +388,35 @@ class Page(object):
 
     @cached_property
     def is_blog_post(self):
-        return is_blog_post(self.html)
+        return self.metadata["is_blog_post"] is not None
 
     @cached_property
     def title(self):
-        return extract_title(self.html)
+        return strip_or_none(self.metadata["title"])
 
     @cached_property
     def description(self):
-        return extract_description(self.html)
+        return strip_or_none(self.metadata["description"])
 
     @cached_property
     @normalize_timestamp
     def date_created(self):
-        i = get_first_xpath(DATE_CREATED_XPATHS, self.html)
-        return parse_date(i) if i else None
+        return parse_timestamp(self.metadata["date_created"])
 
     @cached_property
     @normalize_timestamp
     def date_published(self):
-        i = get_first_xpath(DATE_PUBLISHED_XPATHS, self.html)
-        return parse_date(i) if i else None
+        return parse_timestamp(self.metadata["date_published"])
 
     @cached_property
     @normalize_timestamp
     def date_modified(self):
-        i = get_first_xpath(DATE_MODIFIED_XPATHS, self.html)
-        return parse_date(i) if i else None
+        return parse_timestamp(self.metadata["date_modified"])
 
     @cached_property
     @normalize_timestamp
     def last_modified(self):
-        meta_equiv = get_first_xpath(LAST_MODIFIED_XPATHS, self.html)
-        if meta_equiv:
-            return parse_date(meta_equiv)
+        return parse_timestamp(self.metadata["last_modified"])
 
     def get_publication_date(self):
         return (
@@ -255,62 +438,84 @@ class Page(object):
         )
         return max(dates) if dates else None
 
+    @cached_property
+    def summary(self):
+        summary = SUMMARY_SELECTOR(self.html)
+        if summary:
+            return lxml_inner_html(summary[0]).strip()
+        else:
+            return None
+
+    @cached_property
+    def keywords(self):
+        """The comma-separated schema.org keywords as a list"""
+
+        keywords = []
+        for i in (self.metadata["keywords"] or "").split(","):
+            i = i.strip()
+            if i and i not in keywords:
+                keywords.append(i)
+        return keywords
+
     # schema.org microdata accessors:
     @cached_property
     def articleBody(self):
-        body = self.html.xpath('//*[@itemprop="articleBody"]')
-        if body:
-            return lxml_inner_html(body[0]).strip()
+        body = self.metadata["articleBody"]
+        if body is not None:
+            return lxml_inner_html(body).strip()
         else:
             return ""
 
 
+def strip_or_none(value):
+    return value.strip() if value is not None else None
+
+
 @filename_or_document
 def is_blog_post(html):
-    return any(i(html) for i in BLOG_POST_XPATHS)
+    metadata = METADATA_EXTRACTOR.extract(html, ["is_blog_post"])
+    return metadata["is_blog_post"] is not None
 
 
 @filename_or_document
 def extract_title(html):
-    for xpath in TITLE_XPATHS:
-        res = xpath(html)
-        if res:
-            return res[0].strip()
+    return strip_or_none(METADATA_EXTRACTOR.extract(html, ["title"])["title"])
 
 
 @filename_or_document
 def extract_description(html):
-    for xpath in DESCRIPTION_XPATHS:
-        res = xpath(html)
-        if res:
-            return res[0].strip()
+    return strip_or_none(
+        METADATA_EXTRACTOR.extract(html, ["description"])["description"]
+    )
 
 
-def tidy(filename):
+TIDY_COMMAND = [
+    "tidy-html5",
+    "-utf8",
+    "-quiet",
+    "--tidy-mark",
+    "no",
+    "--wrap",
+    "0",
+    "--indent",
+    "yes",
+    "--indent-spaces",
+    "4",
+]
+
+# See: https://github.com/w3c/tidy-html5/pull/58
+ITEMSCOPE_RE = re.compile(rb"""\bitemscope=(?:""|'')""")
+
+
+def tidy_content(content, filename="<stdin>"):
+    """Return HTML content tidied using tidy-html5, which is read from stdin"""
+
     # This is an ugly travesty and depends on https://github.com/w3c/tidy-html5
     # In its defense, it actually works at all which is more than can be said
     # for html5lib, lxml3, BeautifulSoup, etc. and there are no Python 3
     # migration issues…
-    tidy = Popen(
-        [
-            "tidy-html5",
-            "-utf8",
-            "-modify",
-            "-quiet",
-            "--tidy-mark",
-            "no",
-            "--wrap",
-            "0",
-            "--indent",
-            "yes",
-            "--indent-spaces",
-            "4",
-            filename,
-        ],
-        stderr=PIPE,
-        stdout=PIPE,
-    )
-    stdout, stderr = tidy.communicate()
+    tidy = Popen(TIDY_COMMAND, stdin=PIPE, stderr=PIPE, stdout=PIPE)
+    stdout, stderr = tidy.communicate(content)
 
     if stderr:
         stderr = stderr.decode("utf-8").strip()
@@ -319,5 +524,118 @@ def tidy(filename):
             "HTML tidy reported problems for %s:\n" % filename, stderr, file=sys.stderr
         )
 
-    check_call(["perl", "-p", "-i", "-e", 's|itemscope=""|itemscope|', filename])
-    # See: https://github.com/w3c/tidy-html5/pull/58
+    # As with -modify, the content is left alone if tidy found errors (exit
+    # status 2) rather than warnings:
+    if tidy.returncode < 2 and stdout:
+        content = stdout
+
+    return ITEMSCOPE_RE.sub(b"itemscope", content)
+
+
+def tidy(filename):
+    """Tidy an HTML file in place"""
+
+    with open(filename, "rb") as f:
+        content = f.read()
+
+    content = tidy_content(content, filename)
+
+    with open(filename, "wb") as f:
+        f.write(content)
+
+
+class TidiedFile(
+    StatRecord,
+    namedtuple("TidiedFile", ["source_md5", "size", "inode", "mtime_ns"]),
+):
+    """The MD5 of the content given to tidy and the state of the file written"""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, source_md5, st):
+        return cls(source_md5, st.st_size, st.st_ino, st.st_mtime_ns)
+
+
+class Tidier(object):
+    """
+    Tidy and write files using a bounded pool of tidy-html5 processes
+
+    Content is submitted before it has been written so each file is only
+    written once, after tidying. known is a dictionary of TidiedFile records
+    keyed by real path: a file which would be tidied from the same content as
+    last time and which hasn't changed since is left alone.
+
+    close() waits for everything to finish and returns a dictionary of the
+    new TidiedFile records and a dictionary of errors.
+    """
+
+    def __init__(self, known=None, workers=None):
+        self.known = known or {}
+
+        # tidy-html5 runs in separate processes so threads are sufficient:
+        workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        # Limits the amount of content waiting for a worker:
+        self.pending = BoundedSemaphore(workers * 2)
+
+        self.futures = {}
+        self.skipped = 0
+
+    def submit(self, filename, content):
+        source_md5 = md5(content).hexdigest()
+
+        record = self.known.get(os.path.realpath(filename))
+        if record is not None and record.source_md5 == source_md5:
+            try:
+                unchanged = record.matches(os.stat(filename))
+            except FileNotFoundError:
+                unchanged = False
+
+            if unchanged:
+                logging.debug("%s is already tidy", filename)
+                self.skipped += 1
+                return
+
+        self.pending.acquire()
+        try:
+            future = self.pool.submit(self.tidy, filename, content, source_md5)
+        except Exception:
+            self.pending.release()
+            raise
+        future.add_done_callback(lambda future: self.pending.release())
+
+        self.futures[future] = filename
+
+    def tidy(self, filename, content, source_md5):
+        logging.info("Tidying HTML in %s", filename)
+
+        try:
+            content = tidy_content(content, filename)
+        finally:
+            # The untidy content is still written if tidy fails:
+            with open(filename, "wb") as f:
+                f.write(content)
+                f.flush()
+                st = os.fstat(f.fileno())
+
+        return TidiedFile.from_stat(source_md5, st)
+
+    def close(self):
+        tidied = {}
+        errors = {}
+
+        for future in as_completed(self.futures):
+            filename = self.futures[future]
+            try:
+                tidied[os.path.realpath(filename)] = future.result()
+            except Exception:
+                errors[filename] = traceback.format_exc()
+
+        self.pool.shutdown()
+
+        if self.skipped:
+            logging.info("%d files were already tidy", self.skipped)
+
+        return tidied, errors
@@ -0,0 +1,265 @@
+# encoding: utf-8
+"""
+Static search index for client-side search
+
+The title, description and body of every blog post are tokenized into an
+inverted index which is split into small JSON files by the first characters of
+each term, so a browser only needs to download the shards for the words in a
+query. The postings are stored in the page cache so only posts which have
+changed since the last build are tokenized again and only the shards
+containing their terms are rewritten.
+
+The output directory contains:
+
+index.json
+    The format version, the shard filenames and the tokenizer settings which
+    clients must use for queries: stopwords, stem_rules and min_stem_length.
+
+documents.json
+    An object mapping document ids to [url, title].
+
+A shard for each term prefix
+    An object mapping each term to a flat list of document id deltas and
+    weights: [id₁, weight₁, id₂ - id₁, weight₂, …]. Terms are lower-case
+    and stemmed. A term's shard is named after its first two characters if
+    they're ASCII letters or digits, or otherwise "_" followed by the
+    hex-encoded UTF-8 of the first two characters, plus ".json".
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import glob
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+from html import unescape
+
+from .utils import chunked
+
+INDEX_FORMAT_VERSION = 1
+
+# Terms are grouped into shards using this many characters:
+SHARD_PREFIX_LENGTH = 2
+
+# Number of posts loaded from the cache at a time while tokenizing:
+INDEX_BATCH_SIZE = 500
+
+# The weight of each occurrence of a term in each field:
+FIELD_WEIGHTS = [("title", 5), ("description", 2), ("articleBody", 1)]
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 32
+
+STOPWORDS = frozenset(
+    """
+    a about an and are as at be but by for from has have he i in is it its
+    not of on or she that the their there they this to was we were what when
+    which who will with you your
+    """.split()
+)
+
+# A deliberately simple suffix-stripping stemmer which is easy to reproduce in
+# JavaScript: the first rule whose suffix matches is applied unless that would
+# leave fewer than MIN_STEM_LENGTH characters. Rules which replace a suffix with
+# itself prevent the more general rules after them from matching.
+STEM_RULES = [
+    ("sses", "ss"),
+    ("ies", "y"),
+    ("ss", "ss"),
+    ("us", "us"),
+    ("is", "is"),
+    ("ingly", ""),
+    ("edly", ""),
+    ("ing", ""),
+    ("ed", ""),
+    ("ly", ""),
+    ("s", ""),
+]
+MIN_STEM_LENGTH = 3
+
+TOKEN_RE = re.compile(r"\w+")
+TAG_RE = re.compile(r"<[^>]*>")
+ALPHANUMERIC_RE = re.compile(r"^[a-z0-9]+$")
+
+
+def stem(word):
+    for suffix, replacement in STEM_RULES:
+        if word.endswith(suffix):
+            stemmed = word[: len(word) - len(suffix)] + replacement
+            return stemmed if len(stemmed) >= MIN_STEM_LENGTH else word
+    return word
+
+
+def tokenize(text):
+    """Generator which returns the search terms in plain text"""
+
+    for word in TOKEN_RE.findall(text.casefold()):
+        if MIN_TERM_LENGTH <= len(word) <= MAX_TERM_LENGTH and word not in STOPWORDS:
+            yield stem(word)
+
+
+def html_to_text(html):
+    # The cached fragments are well-formed so this is much faster than parsing:
+    return unescape(TAG_RE.sub(" ", html))
+
+
+def document_weights(page):
+    """Return a dictionary of each term's weight in a page"""
+
+    weights = Counter()
+
+    for field, weight in FIELD_WEIGHTS:
+        value = getattr(page, field) or ""
+        if field == "articleBody":
+            value = html_to_text(value)
+        for term in tokenize(value):
+            weights[term] += weight
+
+    return weights
+
+
+def shard_name(prefix):
+    if ALPHANUMERIC_RE.match(prefix):
+        return prefix + ".json"
+    else:
+        return "_%s.json" % prefix.encode("utf-8").hex()
+
+
+def write_json(filename, data):
+    """Write data as compact JSON if it has changed, returning the size"""
+
+    content = json.dumps(
+        data, ensure_ascii=False, separators=(",", ":"), sort_keys=True
+    ).encode("utf-8")
+
+    try:
+        with open(filename, "rb") as f:
+            unchanged = f.read() == content
+    except FileNotFoundError:
+        unchanged = False
+
+    if not unchanged:
+        with open(filename, "wb") as f:
+            f.write(content)
+
+    return len(content)
+
+
+def write_shard(pages, output_dir, prefix):
+    postings = {}
+    last = {}
+
+    for term, document, weight in pages.get_search_postings(prefix):
+        postings.setdefault(term, []).extend((document - last.get(term, 0), weight))
+        last[term] = document
+
+    filename = os.path.join(output_dir, shard_name(prefix))
+
+    if postings:
+        write_json(filename, postings)
+    elif os.path.exists(filename):
+        os.unlink(filename)
+
+
+def update_search_index(site, output_dir, rebuild=False):
+    """
+    Bring the search index in output_dir up to date with the blog posts
+
+    Returns an ordered list of (name, value) pairs describing the index and
+    the work done.
+    """
+
+    started = time.monotonic()
+
+    pages = site.pages
+
+    if rebuild:
+        pages.clear_search_index()
+
+    current = pages.get_blog_post_signatures()
+    indexed = pages.get_search_documents()
+
+    removed = [i for i in indexed if i not in current]
+    changed = sorted(
+        filename
+        for filename, signature in current.items()
+        if filename not in indexed or indexed[filename][1:] != signature
+    )
+
+    logging.info(
+        "Updating the search index: %d changed and %d removed posts",
+        len(changed),
+        len(removed),
+    )
+
+    # The shards for the terms which were removed or added need to be updated:
+    terms = pages.remove_search_documents(removed)
+
+    for batch in chunked(changed, INDEX_BATCH_SIZE):
+        records = pages.get_pages(batch, content=True)
+        terms.update(
+            pages.replace_search_documents(
+                (filename,) + current[filename] + (document_weights(records[filename]),)
+                for filename in batch
+            )
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    documents_filename = os.path.join(output_dir, "documents.json")
+    if rebuild or changed or removed or not os.path.exists(documents_filename):
+        write_json(
+            documents_filename,
+            {
+                str(document): [site.filename_to_url(filename), title]
+                for document, filename, title in pages.get_search_document_titles()
+            },
+        )
+
+    prefixes = {i[:SHARD_PREFIX_LENGTH] for i in terms}
+    for prefix in sorted(prefixes):
+        write_shard(pages, output_dir, prefix)
+
+    shards = sorted(
+        shard_name(i) for i in pages.get_search_term_prefixes(SHARD_PREFIX_LENGTH)
+    )
+
+    write_json(
+        os.path.join(output_dir, "index.json"),
+        {
+            "version": INDEX_FORMAT_VERSION,
+            "documents": "documents.json",
+            "shards": shards,
+            "stopwords": sorted(STOPWORDS),
+            "stem_rules": STEM_RULES,
+            "min_stem_length": MIN_STEM_LENGTH,
+            "min_term_length": MIN_TERM_LENGTH,
+            "max_term_length": MAX_TERM_LENGTH,
+        },
+    )
+
+    # Shards are removed when they become empty but this also cleans up after
+    # a rebuild or changes to the shard names:
+    expected = set(shards) | {"index.json", "documents.json"}
+    for filename in glob.glob(os.path.join(output_dir, "*.json")):
+        if os.path.basename(filename) not in expected:
+            os.unlink(filename)
+
+    sizes = [
+        os.path.getsize(os.path.join(output_dir, i))
+        for i in shards + ["index.json", "documents.json"]
+    ]
+
+    return [
+        ("Directory", output_dir),
+        ("Documents", len(current)),
+        ("Documents tokenized", len(changed)),
+        ("Documents removed", len(removed)),
+        ("Shards", len(shards)),
+        ("Shards updated", len(prefixes)),
+        ("Index size (bytes)", sum(sizes)),
+        ("Largest file (bytes)", max(sizes)),
+        ("Build time (seconds)", round(time.monotonic() - started, 3)),
+    ]
@@ -2,37 +2,82 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import logging
 import os
 import sqlite3
+import stat
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from configparser import RawConfigParser
+from datetime import datetime, timezone
+from hashlib import md5
+from itertools import chain, repeat
+from operator import itemgetter
 
 from dateutil.parser import parse as parse_date
 
-from .files import find_html_files
-from .html import Page
+from .files import (
+    DEFAULT_RULES,
+    FileRules,
+    StatRecord,
+    is_ignored,
+    md5_file,
+    scan_files,
+)
+from .html import Page, TidiedFile
+from .utils import cached_property, chunked
 
 
 class Site(object):
     def __init__(self, config_filename):
         # BUG: validation & instructions for missing config file
 
-        config_filename = os.path.realpath(config_filename)
+        self.config_filename = config_filename = os.path.realpath(config_filename)
 
         self.base_dir = os.path.dirname(config_filename)
 
+        self.load_config()
+
+    def load_config(self):
         self.config = config = RawConfigParser()
-        config.read(config_filename)
+        config.read(self.config_filename)
 
         self.base_url = config.get("site", "base_url")
 
-        self.pages = PageCache(self.base_dir)
+        self.file_rules = FileRules.from_config(config)
+
+        if "pages" in self.__dict__:
+            self.pages.rules = self.file_rules
+
+    @cached_property
+    def pages(self):
+        return self.get_page_cache()
+
+    def get_page_cache(self, index=True):
+        return PageCache(
+            self.base_dir,
+            workers=self.config.getint("cache", "index_workers", fallback=None),
+            index=index,
+            rules=self.file_rules,
+        )
 
     def filename_to_url(self, filename):
-        path = os.path.relpath(filename, start=self.base_dir)
-        path = path.replace("/index.html", "/")
-        if not path.startswith("/"):
-            path = "/%s" % path
-        return path
+        return filename_to_url(self.base_dir, filename)
+
+
+def filename_to_url(base_dir, filename):
+    prefix = os.path.join(base_dir, "")
+    if filename.startswith(prefix):
+        # Avoid the cost of relpath() for the common case of generating URLs
+        # for every page:
+        path = filename.replace(prefix, "", 1)
+    else:
+        path = os.path.relpath(filename, start=base_dir)
+    path = path.replace("/index.html", "/")
+    if not path.startswith("/"):
+        path = "/%s" % path
+    return path
 
 
 def load_site(base_dir=None):
@@ -42,8 +87,406 @@ def load_site(base_dir=None):
     return Site(os.path.join(base_dir, ".simple-cloud-site.cfg"))
 
 
+def adapt_timestamp(value):
+    """
+    Store datetimes as ISO 8601 in UTC
+
+    This is the only format written to the cache so values sort correctly and
+    can be decoded using datetime.fromisoformat() rather than dateutil, which
+    is only needed to parse the many formats found in HTML.
+    """
+
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.isoformat()
+
+
+def convert_timestamp(value):
+    value = value.decode("utf-8")
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        # Values written by older releases which haven't been reindexed:
+        return parse_date(value)
+
+
 # See http://bugs.python.org/issue19065
-sqlite3.register_converter("timestamp", parse_date)
+sqlite3.register_adapter(datetime, adapt_timestamp)
+sqlite3.register_converter("timestamp", convert_timestamp)
+
+# Rows are written back in batches of this size so a large reindex doesn't hold
+# a single transaction open for the entire run:
+INDEX_BATCH_SIZE = 500
+
+# Starting a process pool isn't worth it for the handful of files changed by a
+# typical edit:
+PARALLEL_INDEX_THRESHOLD = 32
+
+
+def extract_page_metadata(filename, base_dir):
+    """Return the cached column values for an HTML file
+
+    This is a module-level function so it can be used with a process pool
+    """
+
+    return extract_document_metadata(Page(filename).html, filename, base_dir)
+
+
+def extract_document_metadata(document, filename, base_dir):
+    """
+    Return the cached column values for the parsed HTML document in filename,
+    which is modified
+
+    This allows a document which has just been written to be indexed without
+    parsing the file again.
+    """
+
+    page = Page(document, filename=filename)
+
+    # The cached fragments are used to build indices and feeds at other URLs:
+    page.html.getroot().make_links_absolute(filename_to_url(base_dir, filename))
+
+    summary, body = page.summary, page.articleBody
+
+    return (
+        page.is_blog_post,
+        page.title,
+        page.description,
+        page.date_created,
+        page.date_modified,
+        page.date_published,
+        page.last_modified,
+        summary,
+        body,
+        # Lets callers tell whether the fragments changed without loading them:
+        md5(repr((summary, body)).encode("utf-8")).hexdigest(),
+        page.keywords,
+    )
+
+
+IndexChanges = namedtuple("IndexChanges", ["added", "changed", "removed"])
+
+
+class FileRecord(
+    StatRecord, namedtuple("FileRecord", ["size", "inode", "mtime_ns", "md5"])
+):
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, st, md5):
+        return cls(st.st_size, st.st_ino, st.st_mtime_ns, md5)
+
+
+class RenderedFile(
+    StatRecord,
+    namedtuple("RenderedFile", ["size", "inode", "mtime_ns", "fingerprint"]),
+):
+    """The state of a file written by apply-template and a hash of its inputs"""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, st, fingerprint):
+        return cls(st.st_size, st.st_ino, st.st_mtime_ns, fingerprint)
+
+
+CompressedFile = namedtuple("CompressedFile", ["md5", "size"])
+
+PublishedObject = namedtuple(
+    "PublishedObject", ["name", "hash", "size", "content_type"]
+)
+
+
+class PageRecord(object):
+    """
+    The cached metadata for a page
+
+    These are returned by the PageCache queries instead of html.Page objects
+    since they're much smaller and cheaper to create, which matters when
+    loading every page on a large site. The cached summary and articleBody
+    fragments are only loaded by queries which are passed content=True;
+    accessing them on other records raises AttributeError. Anything which isn't
+    cached must be read explicitly using load_page(), which parses the file and
+    is counted in PageRecord.parse_count so these costs are visible.
+    """
+
+    COLUMNS = (
+        "filename",
+        "is_blog_post",
+        "title",
+        "description",
+        "date_created",
+        "date_modified",
+        "date_published",
+        "last_modified",
+        "content_md5",
+    )
+
+    CONTENT_COLUMNS = ("summary", "articleBody")
+
+    __slots__ = COLUMNS + CONTENT_COLUMNS + ("_page",)
+
+    # The number of times a PageRecord had to parse its file:
+    parse_count = 0
+
+    def __init__(self, *values):
+        for name, value in zip(self.COLUMNS + self.CONTENT_COLUMNS, values):
+            setattr(self, name, value)
+        self._page = None
+
+    def __repr__(self):
+        return "<PageRecord %s>" % self.filename
+
+    def load_page(self, reason=None):
+        """Return an html.Page for attributes which aren't cached"""
+
+        if self._page is None:
+            PageRecord.parse_count += 1
+            logging.debug(
+                "Parsing %s to load %s", self.filename, reason or "uncached values"
+            )
+            self._page = Page(self.filename)
+
+        return self._page
+
+    @property
+    def href(self):
+        return self.filename
+
+    def get_publication_date(self):
+        return (
+            self.date_published
+            or self.date_created
+            or self.date_modified
+            or self.last_modified
+        )
+
+    def get_modification_date(self):
+        dates = [
+            i
+            for i in (
+                self.last_modified,
+                self.date_published,
+                self.date_modified,
+                self.date_created,
+            )
+            if i
+        ]
+        return max(dates) if dates else None
+
+
+PAGE_RECORD_QUERY = "SELECT %s FROM pages" % ", ".join(
+    '"%s"' % i for i in PageRecord.COLUMNS
+)
+
+PAGE_CONTENT_QUERY = "SELECT %s FROM pages" % ", ".join(
+    '"%s"' % i for i in PageRecord.COLUMNS + PageRecord.CONTENT_COLUMNS
+)
+
+# The SQL equivalent of PageRecord.get_publication_date(), used to list and
+# group blog posts. This must be written identically in every query so SQLite
+# can use the pages_blog_posts_published index:
+PUBLICATION_DATE = (
+    "COALESCE(date_published, date_created, date_modified, last_modified)"
+)
+
+
+# Each entry is the list of statements which upgrade the schema from the
+# previous version. Always add a new entry rather than changing an existing one
+# so existing caches will be migrated. To force pages to be reindexed after
+# adding a column, reset their mtime: UPDATE pages SET mtime = NULL
+SCHEMA_MIGRATIONS = [
+    [
+        """CREATE TABLE IF NOT EXISTS pages (
+                filename VARCHAR(512) PRIMARY KEY,
+                inode INTEGER,
+                mtime INTEGER,
+                is_blog_post BOOLEAN,
+                title TEXT,
+                description TEXT,
+                date_created TIMESTAMP,
+                date_modified TIMESTAMP,
+                date_published TIMESTAMP
+            )""",
+        """CREATE TABLE IF NOT EXISTS files (
+                filename VARCHAR(512) PRIMARY KEY,
+                size INTEGER,
+                inode INTEGER,
+                mtime_ns INTEGER,
+                md5 CHAR(32)
+            )""",
+        """CREATE TABLE IF NOT EXISTS compressed_files (
+                source_md5 CHAR(32),
+                encoding VARCHAR(16),
+                md5 CHAR(32),
+                size INTEGER,
+                PRIMARY KEY (source_md5, encoding)
+            )""",
+        # The last successfully published state of each container, used to
+        # avoid listing the entire container on every publish:
+        """CREATE TABLE IF NOT EXISTS published_objects (
+                container VARCHAR(256),
+                name VARCHAR(1024),
+                hash CHAR(32),
+                size INTEGER,
+                content_type VARCHAR(256),
+                PRIMARY KEY (container, name)
+            )""",
+        """CREATE TABLE IF NOT EXISTS published_containers (
+                container VARCHAR(256) PRIMARY KEY,
+                verified TIMESTAMP
+            )""",
+    ],
+    [
+        # Blog post listings can be read in date order without sorting:
+        """CREATE INDEX IF NOT EXISTS pages_blog_posts
+                ON pages (is_blog_post, date_published)""",
+    ],
+    [
+        """CREATE TABLE IF NOT EXISTS rendered_files (
+                filename VARCHAR(512) PRIMARY KEY,
+                size INTEGER,
+                inode INTEGER,
+                mtime_ns INTEGER,
+                fingerprint CHAR(64)
+            )""",
+    ],
+    [
+        "ALTER TABLE pages ADD COLUMN summary TEXT",
+        'ALTER TABLE pages ADD COLUMN "articleBody" TEXT',
+        "UPDATE pages SET mtime = NULL",
+    ],
+    # Older releases stored timestamps using str(datetime) in whatever timezone
+    # the page used. Those in UTC only need the ISO 8601 T separator and the
+    # rest are reindexed so they're converted to UTC:
+    [
+        "UPDATE pages SET %s = substr(%s, 1, 10) || 'T' || substr(%s, 12)"
+        " WHERE substr(%s, 11, 1) = ' '" % ((column,) * 4)
+        for column in ("date_created", "date_modified", "date_published")
+    ]
+    + [
+        """UPDATE pages SET mtime = NULL
+            WHERE date_created NOT LIKE '%+00:00'
+                OR date_modified NOT LIKE '%+00:00'
+                OR date_published NOT LIKE '%+00:00'""",
+        """UPDATE published_containers
+            SET verified = substr(verified, 1, 10) || 'T' || substr(verified, 12)
+            WHERE substr(verified, 11, 1) = ' '""",
+    ],
+    [
+        """CREATE TABLE IF NOT EXISTS tidied_files (
+                filename VARCHAR(512) PRIMARY KEY,
+                source_md5 CHAR(32),
+                size INTEGER,
+                inode INTEGER,
+                mtime_ns INTEGER
+            )""",
+    ],
+    [
+        """CREATE TABLE IF NOT EXISTS page_keywords (
+                keyword TEXT,
+                filename VARCHAR(512),
+                PRIMARY KEY (keyword, filename)
+            )""",
+        "CREATE INDEX IF NOT EXISTS page_keywords_filename ON page_keywords (filename)",
+        "UPDATE pages SET mtime = NULL",
+    ],
+    [
+        # The pages included in the static search index and the inode and
+        # mtime of the version which was tokenized:
+        """CREATE TABLE IF NOT EXISTS search_documents (
+                id INTEGER PRIMARY KEY,
+                filename VARCHAR(512) UNIQUE,
+                inode INTEGER,
+                mtime INTEGER
+            )""",
+        """CREATE TABLE IF NOT EXISTS search_postings (
+                term TEXT,
+                document INTEGER,
+                weight INTEGER,
+                PRIMARY KEY (term, document)
+            )""",
+        """CREATE INDEX IF NOT EXISTS search_postings_document
+                ON search_postings (document)""",
+    ],
+    [
+        # The feeds list the most recently modified posts:
+        """CREATE INDEX IF NOT EXISTS pages_blog_posts_modified
+                ON pages (is_blog_post, date_modified)""",
+    ],
+    [
+        # Cached so page records never need to parse the file for dates:
+        "ALTER TABLE pages ADD COLUMN last_modified TIMESTAMP",
+        # A hash of the summary and articleBody fragments:
+        "ALTER TABLE pages ADD COLUMN content_md5 CHAR(32)",
+        "UPDATE pages SET mtime = NULL",
+    ],
+    [
+        # Posts are listed by their publication date, which falls back to
+        # the other dates when a post doesn't have datePublished:
+        "DROP INDEX IF EXISTS pages_blog_posts",
+        """CREATE INDEX IF NOT EXISTS pages_blog_posts_published
+                ON pages (is_blog_post, %s)"""
+        % PUBLICATION_DATE,
+    ],
+]
+
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+CONNECTION_PRAGMAS = [
+    # Readers aren't blocked by writers and commits are much cheaper:
+    "PRAGMA journal_mode = WAL",
+    # This is safe with WAL: only the last transactions could be lost on
+    # power failure, which will simply be reindexed:
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    # 32MB page cache:
+    "PRAGMA cache_size = -32768",
+    "PRAGMA mmap_size = 268435456",
+]
+
+
+class PostIndex(object):
+    """
+    Blog posts sorted by publication date for fast neighbour lookups
+
+    This is built once and can be reused to find the previous and next posts
+    for any number of pages in O(log n) time. Posts without a publication date
+    are not included.
+    """
+
+    def __init__(self, posts):
+        dated = [(post.get_publication_date(), post) for post in posts]
+        # A stable sort keeps the original order for identical dates:
+        dated = sorted((i for i in dated if i[0] is not None), key=itemgetter(0))
+
+        self.dates = [pub_date for pub_date, post in dated]
+        self.posts = [post for pub_date, post in dated]
+
+    def __len__(self):
+        return len(self.posts)
+
+    def __iter__(self):
+        return iter(self.posts)
+
+    def neighbours(self, pub_date):
+        """
+        Return the latest post published before pub_date and the earliest post
+        published after it, using None if there isn't one
+        """
+
+        prev_post = next_post = None
+
+        i = bisect_left(self.dates, pub_date)
+        if i > 0:
+            # Use the first of any posts sharing the same date:
+            prev_post = self.posts[bisect_left(self.dates, self.dates[i - 1])]
+
+        i = bisect_right(self.dates, pub_date)
+        if i < len(self.posts):
+            next_post = self.posts[i]
+
+        return prev_post, next_post
 
 
 class PageCache(object):
@@ -56,108 +499,817 @@ class PageCache(object):
     quick access by checking the file inode + mtime.
     """
 
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, workers=None, index=True, rules=DEFAULT_RULES):
         self.base_dir = base_dir
 
-        db_file = os.path.join(base_dir, ".simple-cloud-site-cache.sqlite")
+        # The FileRules deciding which files are part of the site:
+        self.rules = rules
+
+        # Number of processes used to parse changed pages. The default is one
+        # per CPU; use 1 to index everything in the current process:
+        self.workers = workers or os.cpu_count() or 1
+
+        self.db_file = os.path.join(base_dir, ".simple-cloud-site-cache.sqlite")
         self.conn = conn = sqlite3.connect(
-            db_file, detect_types=sqlite3.PARSE_DECLTYPES
+            self.db_file, detect_types=sqlite3.PARSE_DECLTYPES
         )
         conn.row_factory = sqlite3.Row
 
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+
         self.initialize()
-        self.index_site()
+
+        if index:
+            self.index_site()
 
     def initialize(self):
-        with self.conn as c:
-            # FIXME: schema check!
+        """Create or migrate the cache schema"""
 
+        with self.conn as c:
             c.execute(
-                """CREATE TABLE IF NOT EXISTS pages (
-                             filename VARCHAR(512) PRIMARY KEY,
-                             inode INTEGER,
-                             mtime INTEGER,
-                             is_blog_post BOOLEAN,
-                             title TEXT,
-                             description TEXT,
-                             date_created TIMESTAMP,
-                             date_modified TIMESTAMP,
-                             date_published TIMESTAMP
-                         )"""
+                "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"
             )
 
-    def index_site(self):
+        version = self.get_schema_version()
+
+        if version > SCHEMA_VERSION:
+            # Since this is only a cache it's safer to start over than to
+            # guess how a newer release changed it:
+            logging.warning(
+                "Cache schema version %d is newer than %d; rebuilding it",
+                version,
+                SCHEMA_VERSION,
+            )
+            self.drop_tables()
+            self.initialize()
+            return
+
+        if version == SCHEMA_VERSION:
+            return
+
         with self.conn as c:
-            cursor = c.cursor()
+            # DDL statements don't start a transaction implicitly and we want
+            # each upgrade to be all-or-nothing:
+            c.execute("BEGIN")
 
-            for html_file in find_html_files(self.base_dir):
-                st = os.stat(html_file)
+            for i in range(version, SCHEMA_VERSION):
+                logging.info("Migrating cache schema to version %d", i + 1)
+                for statement in SCHEMA_MIGRATIONS[i]:
+                    c.execute(statement)
 
-                mtime = int(st.st_mtime)
+            c.execute("DELETE FROM schema_version")
+            c.execute("INSERT INTO schema_version VALUES (?)", (SCHEMA_VERSION,))
 
-                cursor.execute(
-                    """SELECT inode, mtime FROM pages WHERE filename = ?""",
-                    (html_file,),
-                )
+    def get_schema_version(self):
+        row = self.conn.execute("SELECT version FROM schema_version").fetchone()
+        return row["version"] if row else 0
 
-                row = cursor.fetchone()
+    def drop_tables(self):
+        tables = [
+            row["name"]
+            for row in self.conn.execute(
+                """SELECT name FROM sqlite_master
+                    WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"""
+            )
+        ]
 
-                if (
-                    row is not None
-                    and row["inode"] == st.st_ino
-                    and row["mtime"] == mtime
-                ):
-                    continue
+        with self.conn as c:
+            for table in tables:
+                c.execute('DROP TABLE "%s"' % table)
+
+    def rebuild(self):
+        """Discard all cached data and reindex the site"""
+
+        self.drop_tables()
+        self.initialize()
+        return self.index_site()
+
+    def vacuum(self):
+        """Update query planner statistics and compact the database"""
+
+        self.conn.execute("ANALYZE")
+        self.conn.execute("VACUUM")
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def get_statistics(self):
+        """Return an ordered list of (name, value) pairs describing the cache"""
+
+        def scalar(sql):
+            return self.conn.execute(sql).fetchone()[0]
+
+        page_size = scalar("PRAGMA page_size")
+
+        return [
+            ("Database", self.db_file),
+            ("Schema version", self.get_schema_version()),
+            ("Journal mode", scalar("PRAGMA journal_mode")),
+            ("Size (bytes)", scalar("PRAGMA page_count") * page_size),
+            ("Unused (bytes)", scalar("PRAGMA freelist_count") * page_size),
+            ("Pages", scalar("SELECT COUNT(*) FROM pages")),
+            ("Blog posts", scalar("SELECT COUNT(*) FROM pages WHERE is_blog_post")),
+            ("Hashed files", scalar("SELECT COUNT(*) FROM files")),
+            ("Rendered files", scalar("SELECT COUNT(*) FROM rendered_files")),
+            ("Tidied files", scalar("SELECT COUNT(*) FROM tidied_files")),
+            ("Search documents", scalar("SELECT COUNT(*) FROM search_documents")),
+            ("Compressed files", scalar("SELECT COUNT(*) FROM compressed_files")),
+            ("Published objects", scalar("SELECT COUNT(*) FROM published_objects")),
+        ]
+
+    def index_site(self):
+        """
+        Bring the cache up to date with the HTML files under base_dir
+
+        The cached file signatures are loaded in a single query and compared
+        against one walk of the directory tree so only added or changed files
+        are parsed and rows for files which no longer exist are purged.
+
+        Returns an IndexChanges tuple with the number of added, changed and
+        removed pages.
+        """
+
+        cached = {
+            row["filename"]: (row["inode"], row["mtime"])
+            for row in self.conn.execute("SELECT filename, inode, mtime FROM pages")
+        }
+
+        added = []
+        changed = []
+
+        for entry in scan_files(self.base_dir, self.rules):
+            if not entry.name.endswith(".html"):
+                continue
+
+            html_file = entry.path
+            st = entry.stat()
+
+            signature = (st.st_ino, int(st.st_mtime))
+
+            old_signature = cached.pop(html_file, None)
+
+            if old_signature is None:
+                added.append((html_file,) + signature)
+            elif old_signature != signature:
+                changed.append((html_file,) + signature)
+
+        # Anything left over was not found during the walk:
+        removed = sorted(cached)
+
+        for filename in removed:
+            print("Removing page: %s" % filename)
+
+        changes = self.update_pages(added, changed, removed)
+
+        logging.info(
+            "Indexed %s: %d added, %d changed, %d removed", self.base_dir, *changes
+        )
+
+        return changes
+
+    def index_files(self, filenames, metadata=None):
+        """
+        Bring the cache up to date for specific files without walking the site
+
+        This is intended for callers like a file watcher which already know
+        what changed so every file is parsed again, even if it was modified
+        within the same second as the cached version. Files which no longer
+        exist or which index_site() would not include are removed.
+
+        metadata is an optional dictionary of the values returned by
+        extract_document_metadata() for files which the caller has just
+        written, which are stored instead of parsing those files again.
+        """
 
-                cursor.execute("""DELETE FROM pages WHERE filename = ?""", (html_file,))
+        added = []
+        changed = []
+        removed = []
 
-                print("Indexing page: %s" % html_file)
+        for filename in sorted(set(filenames)):
+            cached = self.conn.execute(
+                "SELECT 1 FROM pages WHERE filename = ?", (filename,)
+            ).fetchone()
 
-                page = Page(html_file)
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                st = None
 
-                cursor.execute(
-                    """INSERT INTO pages
+            if (
+                st is None
+                or not stat.S_ISREG(st.st_mode)
+                or not filename.endswith(".html")
+                or is_ignored(filename, self.base_dir, self.rules)
+            ):
+                if cached:
+                    removed.append(filename)
+                continue
+
+            signature = (st.st_ino, int(st.st_mtime))
+
+            if cached:
+                changed.append((filename,) + signature)
+            else:
+                added.append((filename,) + signature)
+
+        return self.update_pages(added, changed, removed, metadata)
+
+    def update_pages(self, added, changed, removed, metadata=None):
+        """
+        Parse added and changed (filename, inode, mtime) tuples and remove the
+        rows for the removed filenames, returning an IndexChanges tuple
+
+        Files in the optional metadata dictionary aren't parsed (see
+        index_files).
+        """
+
+        metadata = metadata or {}
+
+        if removed:
+            with self.conn as c:
+                c.executemany(
+                    "DELETE FROM pages WHERE filename = ?", ((i,) for i in removed)
+                )
+                c.executemany(
+                    "DELETE FROM rendered_files WHERE filename = ?",
+                    ((i,) for i in removed),
+                )
+                c.executemany(
+                    "DELETE FROM tidied_files WHERE filename = ?",
+                    ((i,) for i in removed),
+                )
+                c.executemany(
+                    "DELETE FROM page_keywords WHERE filename = ?",
+                    ((i,) for i in removed),
+                )
+
+        rows = chain(
+            (i + metadata[i[0]] for i in added + changed if i[0] in metadata),
+            self.extract_metadata([i for i in added + changed if i[0] not in metadata]),
+        )
+
+        for batch in chunked(rows, INDEX_BATCH_SIZE):
+            with self.conn as c:
+                c.executemany(
+                    "DELETE FROM page_keywords WHERE filename = ?",
+                    ((row[0],) for row in batch),
+                )
+                c.executemany(
+                    "INSERT INTO page_keywords (keyword, filename) VALUES (?, ?)",
+                    ((keyword, row[0]) for row in batch for keyword in row[-1]),
+                )
+                c.executemany(
+                    """INSERT OR REPLACE INTO pages
                             (
                                 filename, inode, mtime,
                                 is_blog_post,
                                 title, description,
-                                date_created, date_modified, date_published
+                                date_created, date_modified, date_published,
+                                last_modified,
+                                summary, "articleBody", content_md5
                             )
-                        VALUES (?,?,?,?,?,?,?,?,?)""",
-                    (
-                        html_file,
-                        st.st_ino,
-                        mtime,
-                        page.is_blog_post,
-                        page.title,
-                        page.description,
-                        page.date_created,
-                        page.date_modified,
-                        page.date_published,
-                    ),
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                    (row[:-1] for row in batch),
+                )
+
+        return IndexChanges(len(added), len(changed), len(removed))
+
+    def extract_metadata(self, files):
+        """
+        Generator which yields complete pages rows for (filename, inode, mtime)
+        tuples, followed by the list of keywords
+
+        Large batches are parsed using a pool of worker processes since lxml
+        parsing is CPU-bound. Results are returned in the same order as the
+        input.
+        """
+
+        filenames = [filename for filename, inode, mtime in files]
+
+        if self.workers > 1 and len(files) >= PARALLEL_INDEX_THRESHOLD:
+            logging.info(
+                "Indexing %d pages using %d processes", len(files), self.workers
+            )
+
+            chunk_size = max(1, min(64, len(files) // (self.workers * 4)))
+
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = pool.map(
+                    extract_page_metadata,
+                    filenames,
+                    repeat(self.base_dir),
+                    chunksize=chunk_size,
+                )
+
+                for file_info, metadata in zip(files, results):
+                    print("Indexing page: %s" % file_info[0])
+                    yield file_info + metadata
+        else:
+            for file_info, filename in zip(files, filenames):
+                print("Indexing page: %s" % filename)
+                yield file_info + extract_page_metadata(filename, self.base_dir)
+
+    def get_file_records(self):
+        """Return a dictionary of the cached FileRecords"""
+
+        return {
+            row["filename"]: FileRecord(
+                row["size"], row["inode"], row["mtime_ns"], row["md5"]
+            )
+            for row in self.conn.execute("SELECT * FROM files")
+        }
+
+    def record_files(self, rows):
+        """Store (filename, size, inode, mtime_ns, md5) rows"""
+
+        with self.conn as c:
+            for batch in chunked(rows, INDEX_BATCH_SIZE):
+                c.executemany(
+                    """INSERT OR REPLACE INTO files
+                            (filename, size, inode, mtime_ns, md5)
+                        VALUES (?,?,?,?,?)""",
+                    batch,
+                )
+
+    def remove_files(self, filenames):
+        with self.conn as c:
+            c.executemany(
+                "DELETE FROM files WHERE filename = ?", ((i,) for i in filenames)
+            )
+
+    def hash_files(self):
+        """
+        Return a dictionary of FileRecords for every file under base_dir
+
+        MD5 hashes are only recalculated for files whose size, inode or mtime
+        no longer match the cached values. Rows for files which no longer exist
+        are purged.
+        """
+
+        cached = self.get_file_records()
+
+        records = {}
+        updated = []
+
+        for entry in scan_files(self.base_dir, self.rules):
+            filename = entry.path
+            st = entry.stat()
+
+            record = cached.pop(filename, None)
+
+            if record is None or not record.matches(st):
+                logging.debug("Hashing %s", filename)
+                record = FileRecord.from_stat(st, md5_file(filename))
+                updated.append((filename,) + record)
+
+            records[filename] = record
+
+        self.record_files(updated)
+
+        # Anything left over was not found during the walk:
+        self.remove_files(cached)
+
+        logging.info(
+            "Hashed %d of %d files under %s", len(updated), len(records), self.base_dir
+        )
+
+        return records
+
+    def get_rendered_files(self):
+        """Return a dictionary of RenderedFiles for apply-template output"""
+
+        return {
+            row["filename"]: RenderedFile(
+                row["size"], row["inode"], row["mtime_ns"], row["fingerprint"]
+            )
+            for row in self.conn.execute("SELECT * FROM rendered_files")
+        }
+
+    def record_rendered_files(self, rows):
+        """Store (filename, size, inode, mtime_ns, fingerprint) rows"""
+
+        with self.conn as c:
+            for batch in chunked(rows, INDEX_BATCH_SIZE):
+                c.executemany(
+                    """INSERT OR REPLACE INTO rendered_files
+                            (filename, size, inode, mtime_ns, fingerprint)
+                        VALUES (?,?,?,?,?)""",
+                    batch,
+                )
+
+    def get_tidied_files(self):
+        """Return a dictionary of the TidiedFiles written by tidy-html5"""
+
+        return {
+            row["filename"]: TidiedFile(
+                row["source_md5"], row["size"], row["inode"], row["mtime_ns"]
+            )
+            for row in self.conn.execute("SELECT * FROM tidied_files")
+        }
+
+    def record_tidied_files(self, tidied):
+        """Store a dictionary of TidiedFiles keyed by filename"""
+
+        with self.conn as c:
+            for batch in chunked(tidied.items(), INDEX_BATCH_SIZE):
+                c.executemany(
+                    """INSERT OR REPLACE INTO tidied_files
+                            (filename, source_md5, size, inode, mtime_ns)
+                        VALUES (?,?,?,?,?)""",
+                    ((filename,) + record for filename, record in batch),
                 )
 
+    def get_compressed_files(self, encoding):
+        """
+        Return a dictionary mapping source content MD5s to the CompressedFile
+        produced using the specified encoding
+        """
+
+        return {
+            row["source_md5"]: CompressedFile(row["md5"], row["size"])
+            for row in self.conn.execute(
+                "SELECT source_md5, md5, size FROM compressed_files WHERE encoding = ?",
+                (encoding,),
+            )
+        }
+
+    def record_compressed_files(self, rows):
+        """Store (source_md5, encoding, md5, size) rows"""
+
+        with self.conn as c:
+            c.executemany(
+                """INSERT OR REPLACE INTO compressed_files
+                        (source_md5, encoding, md5, size)
+                    VALUES (?,?,?,?)""",
+                rows,
+            )
+
+    def get_published_objects(self, container):
+        """Return a dictionary of PublishedObjects from the publish manifest"""
+
+        return {
+            row["name"]: PublishedObject(*row)
+            for row in self.conn.execute(
+                """SELECT name, hash, size, content_type
+                    FROM published_objects WHERE container = ?""",
+                (container,),
+            )
+        }
+
+    def record_published_objects(self, container, objects):
+        """Add or update PublishedObjects in the publish manifest"""
+
+        with self.conn as c:
+            c.executemany(
+                """INSERT OR REPLACE INTO published_objects
+                        (container, name, hash, size, content_type)
+                    VALUES (?,?,?,?,?)""",
+                ((container,) + tuple(i) for i in objects),
+            )
+
+    def replace_published_objects(self, container, objects):
+        """
+        Replace the publish manifest with the provided PublishedObjects, which
+        should be a complete listing of the remote container
+        """
+
+        with self.conn as c:
+            c.execute("DELETE FROM published_objects WHERE container = ?", (container,))
+
+            c.executemany(
+                """INSERT INTO published_objects
+                        (container, name, hash, size, content_type)
+                    VALUES (?,?,?,?,?)""",
+                ((container,) + tuple(i) for i in objects),
+            )
+
+            c.execute(
+                """INSERT OR REPLACE INTO published_containers (container, verified)
+                    VALUES (?, ?)""",
+                (container, datetime.now(timezone.utc)),
+            )
+
+    def get_last_verified(self, container):
+        """Return when the manifest was last reconciled with the container"""
+
+        row = self.conn.execute(
+            "SELECT verified FROM published_containers WHERE container = ?",
+            (container,),
+        ).fetchone()
+
+        return row["verified"] if row else None
+
     def get_all_pages(self):
         with self.conn as conn:
-            c = conn.cursor()
-            for r in c.execute("SELECT * FROM pages ORDER BY date_published"):
-                yield Page.from_cache(dict(r))
+            for r in conn.execute(PAGE_RECORD_QUERY + " ORDER BY date_published"):
+                yield PageRecord(*r)
+
+    def get_pages(self, filenames, content=False):
+        """
+        Return a dictionary of the cached PageRecords for the given filenames,
+        including the summary and articleBody if content is True
+        """
+
+        query = PAGE_CONTENT_QUERY if content else PAGE_RECORD_QUERY
+
+        pages = {}
+
+        with self.conn as conn:
+            for batch in chunked(filenames, INDEX_BATCH_SIZE):
+                for r in conn.execute(
+                    query + " WHERE filename IN (%s)" % ",".join("?" * len(batch)),
+                    batch,
+                ):
+                    pages[r["filename"]] = PageRecord(*r)
+
+        return pages
+
+    def get_page_metadata(self, filenames):
+        """
+        Return a dictionary of the cached metadata and keywords for the given
+        filenames, which can be compared before and after reindexing them to
+        find what changed
+        """
+
+        metadata = {}
+
+        for filename, page in self.get_pages(filenames).items():
+            metadata[filename] = {i: getattr(page, i) for i in PageRecord.COLUMNS}
+            metadata[filename]["keywords"] = set()
 
-    def get_blog_posts(self):
         with self.conn as conn:
-            c = conn.cursor()
-            for r in c.execute(
-                "SELECT * FROM pages WHERE is_blog_post = 1 ORDER BY date_published"
+            for batch in chunked(list(metadata), INDEX_BATCH_SIZE):
+                for filename, keyword in conn.execute(
+                    "SELECT filename, keyword FROM page_keywords"
+                    " WHERE filename IN (%s)" % ",".join("?" * len(batch)),
+                    batch,
+                ):
+                    metadata[filename]["keywords"].add(keyword)
+
+        return metadata
+
+    def get_page_dates(self):
+        """
+        Yield (filename, title, date_modified) rows for every page
+
+        This avoids loading full page records for callers like the sitemap
+        which need to stream through every page.
+        """
+
+        with self.conn as conn:
+            yield from conn.execute(
+                """SELECT filename, title, date_modified FROM pages
+                    ORDER BY date_published"""
+            )
+
+    def get_blog_posts(self, dated=False):
+        """
+        Yield the blog posts in order of publication, leaving out any without a
+        publication date if dated is True
+        """
+
+        query = PAGE_RECORD_QUERY + " WHERE is_blog_post = 1"
+        if dated:
+            query += " AND %s IS NOT NULL" % PUBLICATION_DATE
+
+        with self.conn as conn:
+            for r in conn.execute(query + " ORDER BY %s" % PUBLICATION_DATE):
+                yield PageRecord(*r)
+
+    def get_recently_modified_posts(self):
+        """
+        Yield the blog posts which have a title and a modification date, most
+        recently modified first
+
+        These include the articleBody and summary, so callers should stop once
+        they have as many as they need and the rest are never loaded.
+        """
+
+        with self.conn as conn:
+            for r in conn.execute(
+                PAGE_CONTENT_QUERY
+                + """ WHERE is_blog_post = 1
+                        AND title != ''
+                        AND date_modified IS NOT NULL
+                        ORDER BY date_modified DESC"""
             ):
-                yield Page.from_cache(dict(r))
+                yield PageRecord(*r)
 
     def get_recent_posts(self, count=10):
         with self.conn as conn:
-            c = conn.cursor()
-            for r in c.execute(
-                """SELECT * FROM pages WHERE is_blog_post = 1
-                                    ORDER BY date_published DESC
-                                    LIMIT %s"""
-                % count
+            for r in conn.execute(
+                PAGE_RECORD_QUERY
+                + """ WHERE is_blog_post = 1 AND {0} IS NOT NULL
+                        ORDER BY {0} DESC
+                        LIMIT {1:d}""".format(
+                    PUBLICATION_DATE, count
+                )
+            ):
+                yield PageRecord(*r)
+
+    def get_blog_post_count(self, dated=False):
+        query = "SELECT COUNT(*) FROM pages WHERE is_blog_post = 1"
+        if dated:
+            query += " AND %s IS NOT NULL" % PUBLICATION_DATE
+
+        return self.conn.execute(query).fetchone()[0]
+
+    def get_blog_post_years(self):
+        """
+        Return a list of (year, post count) in order, by publication date
+
+        Timestamps are stored in UTC so this is the year in UTC: a post
+        published on the evening of December 31st west of Greenwich is counted
+        in the following year.
+        """
+
+        with self.conn as conn:
+            return [
+                (int(year), count)
+                for year, count in conn.execute(
+                    """SELECT substr(%s, 1, 4) AS year, COUNT(*)
+                        FROM pages
+                        WHERE is_blog_post = 1 AND %s IS NOT NULL
+                        GROUP BY year
+                        ORDER BY year"""
+                    % (PUBLICATION_DATE, PUBLICATION_DATE)
+                )
+            ]
+
+    def get_blog_posts_by_year(self, year):
+        """Yield the blog posts published in a year, in UTC like get_blog_post_years"""
+
+        # Timestamps are stored as UTC ISO 8601 so this can use the index. The
+        # trailing - prevents SQLite converting the bounds to numbers because of
+        # the column's numeric affinity:
+        with self.conn as conn:
+            for r in conn.execute(
+                PAGE_RECORD_QUERY
+                + """ WHERE is_blog_post = 1
+                        AND %s >= ? AND %s < ?
+                        ORDER BY %s"""
+                % ((PUBLICATION_DATE,) * 3),
+                ("%04d-" % year, "%04d-" % (year + 1)),
+            ):
+                yield PageRecord(*r)
+
+    def get_keywords(self):
+        """
+        Return a list of (keyword, post count) for the keywords of the blog
+        posts which have a publication date
+        """
+
+        with self.conn as conn:
+            return conn.execute(
+                """SELECT keyword, COUNT(*)
+                    FROM page_keywords JOIN pages USING (filename)
+                    WHERE is_blog_post = 1 AND %s IS NOT NULL
+                    GROUP BY keyword
+                    ORDER BY keyword"""
+                % PUBLICATION_DATE
+            ).fetchall()
+
+    def get_blog_posts_by_keyword(self, keywords):
+        """
+        Yield the blog posts which have any of the given keywords and a
+        publication date
+        """
+
+        keywords = list(keywords)
+
+        with self.conn as conn:
+            for r in conn.execute(
+                PAGE_RECORD_QUERY
+                + """ WHERE is_blog_post = 1 AND {1} IS NOT NULL AND filename IN (
+                            SELECT filename FROM page_keywords
+                            WHERE keyword IN ({0})
+                        )
+                        ORDER BY {1}""".format(
+                    ",".join("?" * len(keywords)), PUBLICATION_DATE
+                ),
+                keywords,
             ):
-                yield Page.from_cache(dict(r))
+                yield PageRecord(*r)
+
+    def get_blog_post_signatures(self):
+        """Return a dictionary of the (inode, mtime) of every blog post"""
+
+        return {
+            row["filename"]: (row["inode"], row["mtime"])
+            for row in self.conn.execute(
+                "SELECT filename, inode, mtime FROM pages WHERE is_blog_post = 1"
+            )
+        }
+
+    def get_search_documents(self):
+        """Return a dictionary of the (id, inode, mtime) of each search document"""
+
+        return {
+            row["filename"]: (row["id"], row["inode"], row["mtime"])
+            for row in self.conn.execute("SELECT * FROM search_documents")
+        }
+
+    def remove_search_documents(self, filenames):
+        """Remove documents from the search index, returning their terms"""
+
+        terms = set()
+
+        with self.conn as c:
+            for filename in filenames:
+                row = c.execute(
+                    "SELECT id FROM search_documents WHERE filename = ?", (filename,)
+                ).fetchone()
+                if row is None:
+                    continue
+
+                document = (row["id"],)
+                terms.update(
+                    i[0]
+                    for i in c.execute(
+                        "SELECT term FROM search_postings WHERE document = ?", document
+                    )
+                )
+                c.execute("DELETE FROM search_postings WHERE document = ?", document)
+                c.execute("DELETE FROM search_documents WHERE id = ?", document)
+
+        return terms
+
+    def replace_search_documents(self, documents):
+        """
+        Store (filename, inode, mtime, weights) tuples where weights is a
+        dictionary of terms, returning the previous and new terms
+
+        Documents which were already indexed keep the same id.
+        """
+
+        terms = set()
+
+        with self.conn as c:
+            for filename, inode, mtime, weights in documents:
+                row = c.execute(
+                    "SELECT id FROM search_documents WHERE filename = ?", (filename,)
+                ).fetchone()
+
+                if row is None:
+                    document = c.execute(
+                        """INSERT INTO search_documents (filename, inode, mtime)
+                            VALUES (?,?,?)""",
+                        (filename, inode, mtime),
+                    ).lastrowid
+                else:
+                    document = row["id"]
+                    terms.update(
+                        i[0]
+                        for i in c.execute(
+                            "SELECT term FROM search_postings WHERE document = ?",
+                            (document,),
+                        )
+                    )
+                    c.execute(
+                        "DELETE FROM search_postings WHERE document = ?", (document,)
+                    )
+                    c.execute(
+                        "UPDATE search_documents SET inode = ?, mtime = ? WHERE id = ?",
+                        (inode, mtime, document),
+                    )
+
+                c.executemany(
+                    """INSERT INTO search_postings (term, document, weight)
+                        VALUES (?,?,?)""",
+                    ((term, document, weight) for term, weight in weights.items()),
+                )
+                terms.update(weights)
+
+        return terms
+
+    def clear_search_index(self):
+        with self.conn as c:
+            c.execute("DELETE FROM search_postings")
+            c.execute("DELETE FROM search_documents")
+
+    def get_search_postings(self, prefix):
+        """Yield (term, document, weight) for terms starting with prefix"""
+
+        # U+10FFFF sorts after every other character:
+        yield from self.conn.execute(
+            """SELECT term, document, weight FROM search_postings
+                WHERE term >= ? AND term < ?
+                ORDER BY term, document""",
+            (prefix, prefix + "\U0010ffff"),
+        )
+
+    def get_search_term_prefixes(self, length):
+        return [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT DISTINCT substr(term, 1, ?) FROM search_postings", (length,)
+            )
+        ]
+
+    def get_search_document_titles(self):
+        """Yield (id, filename, title) for every search document"""
+
+        yield from self.conn.execute(
+            """SELECT id, filename, title
+                FROM search_documents JOIN pages USING (filename)
+                ORDER BY id"""
+        )
@@ -0,0 +1,179 @@
+# encoding: utf-8
+"""In-process libcloud storage driver for testing and benchmarking publish"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import time
+from collections import defaultdict
+from hashlib import md5
+from threading import Lock
+
+from libcloud.storage.base import Container, Object, StorageDriver
+from libcloud.storage.types import (
+    ContainerAlreadyExistsError,
+    ContainerDoesNotExistError,
+    ObjectDoesNotExistError,
+)
+
+# Objects per simulated request when listing a container, matching Swift:
+LIST_PAGE_SIZE = 10000
+
+
+class MemoryStore(object):
+    """
+    Shared state for MemoryStorageDriver instances
+
+    publish uses a separate driver instance for each upload thread so the
+    containers and request counters need to live outside of the driver.
+    Object contents are not retained: only their name, size, hash and extra
+    metadata are kept.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.containers = {}
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def record_request(self, bytes_sent=0):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+
+
+MEMORY_STORES = defaultdict(MemoryStore)
+
+
+class MemoryStorageDriver(StorageDriver):
+    """
+    A storage driver which keeps everything in memory
+
+    Every operation counts as one request and optionally sleeps for latency
+    seconds to approximate a remote service.
+    """
+
+    name = "In-memory storage"
+    website = "https://github.com/acdha/simple-cloud-site/"
+    hash_type = "md5"
+
+    def __init__(self, key="memory", secret=None, latency=0, store="default", **kwargs):
+        super().__init__(key, secret=secret, **kwargs)
+        self.latency = latency
+        self.store = MEMORY_STORES[store]
+
+    def _request(self, bytes_sent=0):
+        if self.latency:
+            time.sleep(self.latency)
+        self.store.record_request(bytes_sent)
+
+    def iterate_containers(self):
+        self._request()
+        for name in list(self.store.containers):
+            yield Container(name=name, extra={}, driver=self)
+
+    def get_container(self, container_name):
+        self._request()
+        if container_name not in self.store.containers:
+            raise ContainerDoesNotExistError(None, self, container_name)
+        return Container(name=container_name, extra={}, driver=self)
+
+    def create_container(self, container_name):
+        self._request()
+        with self.store.lock:
+            if container_name in self.store.containers:
+                raise ContainerAlreadyExistsError(None, self, container_name)
+            self.store.containers[container_name] = {}
+        return Container(name=container_name, extra={}, driver=self)
+
+    def iterate_container_objects(self, container, prefix=None, ex_prefix=None):
+        prefix = prefix or ex_prefix or ""
+
+        objects = sorted(self.store.containers[container.name].items())
+
+        for i, (name, (size, data_hash, extra)) in enumerate(objects):
+            if i % LIST_PAGE_SIZE == 0:
+                self._request()
+            if name.startswith(prefix):
+                yield Object(
+                    name=name,
+                    size=size,
+                    hash=data_hash,
+                    extra=dict(extra),
+                    meta_data={},
+                    container=container,
+                    driver=self,
+                )
+
+    def get_object(self, container_name, object_name):
+        self._request()
+        try:
+            size, data_hash, extra = self.store.containers[container_name][object_name]
+        except KeyError:
+            raise ObjectDoesNotExistError(None, self, object_name)
+        return Object(
+            name=object_name,
+            size=size,
+            hash=data_hash,
+            extra=dict(extra),
+            meta_data={},
+            container=self.get_container(container_name),
+            driver=self,
+        )
+
+    def upload_object(
+        self,
+        file_path,
+        container,
+        object_name,
+        extra=None,
+        verify_hash=True,
+        headers=None,
+    ):
+        with open(file_path, "rb") as f:
+            return self.upload_object_via_stream(
+                f, container, object_name, extra=extra, headers=headers
+            )
+
+    def upload_object_via_stream(
+        self, iterator, container, object_name, extra=None, headers=None
+    ):
+        h = md5()
+        size = 0
+
+        if hasattr(iterator, "read"):
+            stream = iterator
+            iterator = iter(lambda: stream.read(65536), b"")
+
+        for chunk in iterator:
+            h.update(chunk)
+            size += len(chunk)
+
+        self._request(bytes_sent=size)
+
+        extra = dict(extra or {})
+        if headers and "Content-Encoding" in headers:
+            extra["content_encoding"] = headers["Content-Encoding"]
+
+        with self.store.lock:
+            self.store.containers[container.name][object_name] = (
+                size,
+                h.hexdigest(),
+                extra,
+            )
+
+        return Object(
+            name=object_name,
+            size=size,
+            hash=h.hexdigest(),
+            extra=dict(extra),
+            meta_data={},
+            container=container,
+            driver=self,
+        )
+
+    def delete_object(self, obj):
+        self._request()
+        with self.store.lock:
+            return (
+                self.store.containers[obj.container.name].pop(obj.name, None)
+                is not None
+            )
@@ -2,37 +2,219 @@
 # encoding: utf-8
 from __future__ import absolute_import, print_function, unicode_literals
 
+import json
 import logging
 import os
+from collections import OrderedDict
+from copy import deepcopy
 from datetime import datetime, timezone
+from hashlib import sha256
 
+from lxml.cssselect import CSSSelector
+from lxml.etree import SubElement
 from lxml.html import tostring
 from pyquery import PyQuery
 
 from simple_cloud_site.html import Page, parse_html, tidy
+from simple_cloud_site.site import PostIndex, extract_document_metadata
+
+PLACEHOLDER_SELECTOR = CSSSelector(".placeholder")
+
+
+def element_path(elem):
+    """Return the child indexes leading from the root element to elem"""
+
+    path = []
+    parent = elem.getparent()
+    while parent is not None:
+        path.append(parent.index(elem))
+        elem, parent = parent, parent.getparent()
+    path.reverse()
+    return tuple(path)
+
+
+def resolve_element_path(root, path):
+    elem = root
+    for i in path:
+        elem = elem[i]
+    return elem
+
+
+class CompiledTemplate(object):
+    """
+    A template which is parsed once and can render any number of files
+
+    The location of each slot is recorded when the template is loaded so
+    rendering only needs to copy the parsed document rather than parsing the
+    template and running every CSS selector again for each file.
+    """
+
+    SLOTS = OrderedDict(
+        [
+            ("title", 'title,*[itemprop="title"]'),
+            ("dateCreated", '*[itemprop="dateCreated"]'),
+            ("dateModified", '*[itemprop="dateModified"]'),
+            ("datePublished", '*[itemprop="datePublished"]'),
+            ("date", "time.date"),
+            ("last_modified", 'meta[http-equiv="last-modified"]'),
+            ("summary", ".summary"),
+            ("articleBody", '*[itemprop="articleBody"]'),
+            ("description", 'meta[name="description"]'),
+            ("keywords", 'meta[name="keywords"],meta[itemprop="keywords"]'),
+            ("post_nav", "#post-nav"),
+            ("previous", "#post-nav .previous"),
+            ("next", "#post-nav .next"),
+        ]
+    )
+
+    def __init__(self, filename):
+        logging.debug("Loading template file %s", filename)
+
+        self.filename = filename
+        self.document = parse_html(filename)
+
+        root = PyQuery(self.document.getroot())
+
+        self.slots = OrderedDict(
+            (name, [element_path(i) for i in root(selector)])
+            for name, selector in self.SLOTS.items()
+        )
+
+    def copy(self):
+        """Return a copy of the parsed template document"""
+        return deepcopy(self.document)
+
+    def render(self):
+        """
+        Return a copy of the template document and a dictionary of PyQuery
+        objects for each of its slots
+        """
+
+        document = self.copy()
+        root = document.getroot()
+
+        # Every slot is located before anything is modified so the paths are
+        # still valid:
+        slots = {
+            name: PyQuery([resolve_element_path(root, i) for i in paths])
+            for name, paths in self.slots.items()
+        }
+
+        return document, slots
+
+
+def render_fingerprint(inputs, page, site, blog_posts):
+    """
+    Return a hash of everything apply_template uses to render a cached page
+
+    inputs identifies whatever is shared by every file: the template, the site
+    configuration and the command options. This must be kept in sync with
+    apply_template so a file is rendered again whenever its output would change.
+    None is returned when the output depends on the current time.
+    """
+
+    pub_date = page.get_publication_date()
+    if pub_date is None:
+        return None
+
+    if blog_posts:
+        neighbours = [
+            (i.title, site.filename_to_url(i.filename)) if i else None
+            for i in blog_posts.neighbours(pub_date)
+        ]
+    else:
+        neighbours = None
+
+    fields = [
+        inputs,
+        page.is_blog_post,
+        page.title,
+        page.description,
+        page.date_created,
+        page.date_modified,
+        page.date_published,
+        neighbours,
+    ]
+
+    return sha256(json.dumps(fields, default=str).encode("utf-8")).hexdigest()
 
 
 def apply_template(
-    template_filename,
+    template,
     filename,
     site,
     blog_posts=None,
     tidy_html=False,
     update_timestamps=False,
+    tidier=None,
 ):
-    """Create or update an HTML file using a template"""
+    """
+    Create or update an HTML file using a template
+
+    blog_posts is used for the previous/next post navigation. Pass a PostIndex
+    when updating more than one file so it is only built once. When tidying
+    more than one file, pass an html.Tidier so the output is tidied in the
+    background and only written once.
+
+    Returns the page cache metadata for the new content (see
+    PageCache.index_files) so it doesn't need to be parsed again, or None
+    when tidying since tidy-html5 changes the content.
+    """
+
+    document = render_document(
+        template,
+        filename,
+        site,
+        blog_posts=blog_posts,
+        update_timestamps=update_timestamps,
+    )
+    content = tostring(document, method="html", encoding="utf-8")
+
+    if tidy_html and tidier is not None:
+        tidier.submit(filename, content)
+        return None
+
+    logging.info("Saving %s", filename)
+    with open(filename, "wb") as f:
+        f.write(content)
 
-    logging.debug("Loading template file %s", template_filename)
-    template = PyQuery(
-        parse_html(template_filename).getroot()
-    )  # TODO: cache parsed templates
+    if tidy_html:
+        logging.info("Tidying HTML in %s", filename)
+        tidy(filename)
+        return None
+
+    return extract_document_metadata(document, filename, site.base_dir)
+
+
+def render_template(template, filename, site, blog_posts=None, update_timestamps=False):
+    """Return the content apply_template would write to filename"""
+
+    document = render_document(
+        template,
+        filename,
+        site,
+        blog_posts=blog_posts,
+        update_timestamps=update_timestamps,
+    )
+
+    # We don't use template.outerHtml because that would lose the doctype
+    return tostring(document, method="html", encoding="utf-8")
+
+
+def render_document(template, filename, site, blog_posts=None, update_timestamps=False):
+    """Return the document apply_template would write to filename"""
+
+    if not isinstance(template, CompiledTemplate):
+        template = CompiledTemplate(template)
+
+    document, slots = template.render()
 
     if os.path.exists(filename):
         logging.info("Loading HTML file %s", filename)
         original_post = Page(filename)
     else:
         logging.info("Creating new HTML file %s", filename)
-        original_post = Page(template_filename)
+        original_post = Page(template.copy(), filename=template.filename)
         update_timestamps = True
 
         # We'll open the template file and prepare the destination:
@@ -42,9 +224,7 @@ def apply_template(
 
     original = PyQuery(original_post.html.getroot())
 
-    template('title,*[itemprop="title"]').removeClass("placeholder").text(
-        original_post.title
-    )
+    slots["title"].removeClass("placeholder").text(original_post.title)
 
     logging.debug("Processing timestamps")
 
@@ -61,7 +241,7 @@ def apply_template(
         if update_timestamps or not src_val:
             src_val = now.isoformat()
 
-        target = template('*[itemprop="%s"]' % i)
+        target = slots[i]
         if target:
             target.attr("datetime" if target.is_("time") else "content", src_val)
 
@@ -70,79 +250,79 @@ def apply_template(
         post_date = now
 
     # TODO: make post date format configurable
-    template("time.date").removeClass("placeholder").text(
-        post_date.strftime("%b %d")
-    ).attr("datetime", post_date.isoformat())
+    slots["date"].removeClass("placeholder").text(post_date.strftime("%b %d")).attr(
+        "datetime", post_date.isoformat()
+    )
 
     last_modified = original_post.last_modified
     if update_timestamps or not last_modified:
         last_modified = now
 
-    template('meta[http-equiv="last-modified"]').attr(
+    slots["last_modified"].attr(
         "content", last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT")
     )
 
     logging.debug("Updating summary")
     summary = original(".summary").eq(0)
     if summary:
-        template(".summary").removeClass("placeholder").empty().html(summary.html())
+        slots["summary"].removeClass("placeholder").empty().html(summary.html())
     else:
-        template(".summary").remove()
+        slots["summary"].remove()
 
     logging.debug("Updating body")
-    template('*[itemprop="articleBody"]').removeClass("placeholder").empty().append(
+    slots["articleBody"].removeClass("placeholder").empty().append(
         original('*[itemprop="articleBody"]').children()
     )
 
     logging.debug("Updating meta description")
     desc = original_post.description or summary.text()
     if desc:
-        template('meta[name="description"]').attr("content", desc)
+        slots["description"].attr("content", desc)
     else:
-        template('meta[name="description"]').remove()
+        slots["description"].remove()
+
+    logging.debug("Updating keywords")
+    keywords = ", ".join(original_post.keywords)
+    if keywords:
+        if not slots["keywords"]:
+            # The keyword archives need these even if the template doesn't:
+            slots["keywords"] = PyQuery(
+                [
+                    SubElement(i, "meta", name="keywords")
+                    for i in document.getroot().iter("head")
+                ]
+            )
+        slots["keywords"].attr("content", keywords)
+    else:
+        slots["keywords"].remove()
 
     logging.debug("Updating navigation")
-    post_nav = template("#post-nav")
+    post_nav = slots["post_nav"]
     if not blog_posts:
         post_nav.remove()
     else:
-        prev_post = next_post = None
-
-        for post in blog_posts:
-            pub_date = post.get_publication_date()
+        if not isinstance(blog_posts, PostIndex):
+            blog_posts = PostIndex(blog_posts)
 
-            if pub_date < post_date and (
-                not prev_post or pub_date > prev_post.date_published
-            ):
-                prev_post = post
-            elif pub_date > post_date and (
-                not next_post or pub_date < next_post.date_published
-            ):
-                next_post = post
+        prev_post, next_post = blog_posts.neighbours(post_date)
 
         if not prev_post:
-            post_nav(".previous").remove()
+            slots["previous"].remove()
         else:
-            post_nav(".previous").removeClass("placeholder").attr(
+            slots["previous"].removeClass("placeholder").attr(
                 "href", site.filename_to_url(prev_post.filename)
             ).text(prev_post.title)
 
         if not next_post:
-            post_nav(".next").remove()
+            slots["next"].remove()
         else:
-            post_nav(".next").removeClass("placeholder").attr(
+            slots["next"].removeClass("placeholder").attr(
                 "href", site.filename_to_url(next_post.href)
             ).text(next_post.title)
 
-    orphans = template.find(".placeholder")
+    root = document.getroot()
+    orphans = PyQuery([i for i in PLACEHOLDER_SELECTOR(root) if i is not root])
     if orphans:
         logging.warning("Template contained unexpanded placeholders: %s", orphans)
 
-    logging.info("Saving %s", filename)
-    with open(filename, "wb") as f:
-        # We don't use template.outerHtml because that would lose the doctype
-        f.write(tostring(template[0].getroottree(), method="html", encoding="utf-8"))
-
-    if tidy_html:
-        logging.info("Tidying HTML in %s", filename)
-        tidy(filename)
+    return document
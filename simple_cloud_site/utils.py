@@ -1,10 +1,23 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+from itertools import islice
+
 # encoding: utf-8
 
+
 MISSING = object()
 
 
+def chunked(iterable, size):
+    """Generator which yields lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class cached_property(object):
     # Lightly adapted from the Werkzeug cached_property decorator: see
     # https://github.com/mitsuhiko/werkzeug/blob/master/werkzeug/utils.py
@@ -0,0 +1,253 @@
+# encoding: utf-8
+"""Detect changes to the files in a site
+
+InotifyWatcher uses the Linux inotify API through ctypes so it doesn't need any
+additional packages. PollingWatcher works everywhere by periodically comparing
+the results of stat() for every file.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from .files import DEFAULT_RULES
+
+# Templates are excluded from the site but changes to them affect the output:
+WATCHED_DIRECTORIES = {"_templates"}
+
+# Other dotfiles, which include the cache database, are ignored:
+WATCHED_DOTFILES = {".simple-cloud-site.cfg"}
+
+# Returned instead of a set of filenames when the watcher has lost track of what
+# changed and everything needs to be checked:
+EVERYTHING = None
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+INOTIFY_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def is_watched(rules, name, path, is_dir=False):
+    """
+    Return whether changes to a file or directory, at the /-separated path
+    relative to the site directory, can affect the site: it must be part of
+    the site according to rules or be a template or the site configuration
+    """
+
+    if name in (WATCHED_DIRECTORIES if is_dir else WATCHED_DOTFILES):
+        return True
+
+    return not rules.is_excluded(name, path, is_dir)
+
+
+def relative_path(base_dir, filename):
+    return os.path.relpath(filename, base_dir).replace(os.sep, "/")
+
+
+def walk_watched(base_dir, rules, directory=None):
+    """Yield (directory, filenames) for every watched directory in directory"""
+
+    for root, dirs, files in os.walk(directory or base_dir):
+        prefix = relative_path(base_dir, root) + "/" if root != base_dir else ""
+        dirs[:] = [i for i in dirs if is_watched(rules, i, prefix + i, is_dir=True)]
+        yield root, [i for i in files if is_watched(rules, i, prefix + i)]
+
+
+class PollingWatcher(object):
+    def __init__(self, base_dir, rules=DEFAULT_RULES, interval=0.5):
+        self.base_dir = base_dir
+        self.rules = rules
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+
+        for root, files in walk_watched(self.base_dir, self.rules):
+            for name in files:
+                filename = os.path.join(root, name)
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                snapshot[filename] = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Return the set of files which have been added, changed or removed,
+        waiting up to timeout seconds for something to change
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            snapshot = self.scan()
+
+            changed = {
+                filename
+                for filename in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(filename) != self.snapshot.get(filename)
+            }
+
+            self.snapshot = snapshot
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    def __init__(self, base_dir, rules=DEFAULT_RULES, settle=0.05):
+        self.base_dir = base_dir
+        self.rules = rules
+        # Editors often save using several operations so events are collected
+        # until there have been none for this many seconds:
+        self.settle = settle
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.directories = {}
+
+        self.add_tree(base_dir)
+
+    def is_watched(self, path, is_dir=False):
+        return is_watched(
+            self.rules,
+            os.path.basename(path),
+            relative_path(self.base_dir, path),
+            is_dir=is_dir,
+        )
+
+    def add_watch(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.directories[wd] = directory
+
+    def add_tree(self, directory):
+        """Watch a directory and its subdirectories, returning their files"""
+
+        filenames = set()
+
+        for root, files in walk_watched(self.base_dir, self.rules, directory):
+            self.add_watch(root)
+            filenames.update(os.path.join(root, i) for i in files)
+
+        return filenames
+
+    def read_events(self, timeout):
+        """Yield (mask, path) for events received within timeout seconds"""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            offset = start + length
+            name = os.fsdecode(data[start:offset].rstrip(b"\0"))
+
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+
+            directory = self.directories.get(wd)
+            if directory is None and not mask & IN_Q_OVERFLOW:
+                continue
+
+            yield mask, os.path.join(directory, name) if directory else None
+
+    def wait(self, timeout=None):
+        """
+        Return the set of files which have been added, changed or removed,
+        waiting up to timeout seconds for something to change
+
+        EVERYTHING is returned if events were lost or a directory was moved or
+        removed, since the affected files aren't known.
+        """
+
+        changed = set()
+        lost_track = False
+
+        wait = timeout
+
+        while True:
+            events = list(self.read_events(wait))
+            if not events:
+                break
+
+            for mask, path in events:
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning("Too many changes to track; rechecking everything")
+                    lost_track = True
+                elif mask & IN_ISDIR:
+                    if not self.is_watched(path, is_dir=True):
+                        continue
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        changed.update(self.add_tree(path))
+                    elif mask & (IN_MOVED_FROM | IN_DELETE):
+                        lost_track = True
+                elif self.is_watched(path):
+                    changed.add(path)
+
+            wait = self.settle
+
+        return EVERYTHING if lost_track else changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(base_dir, rules=DEFAULT_RULES, polling=False):
+    """
+    Return an InotifyWatcher if possible or a PollingWatcher otherwise, which
+    watch the files in base_dir which are part of the site according to rules
+    """
+
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(base_dir, rules)
+        except (AttributeError, OSError) as exc:
+            # e.g. the inotify watch limit has been reached:
+            logging.warning("Unable to use inotify, polling for changes: %s", exc)
+
+    return PollingWatcher(base_dir, rules)